@@ -0,0 +1,206 @@
+"""
+Per-step time of the no-repeat n-gram bans during batched decoding.
+
+Three paths, which must ban the same tokens:
+  processor    previous behaviour: the settings travelled as a (no-op) logits
+               processor, so vLLM V0 also ran its per-sequence logits
+               processor loop every step (inspect.signature, a tuple copy of
+               the whole output, a row write-back; reproduced below from vLLM
+               0.8.5's _apply_logits_processors), then the batched bans
+               rescanned every window
+  rescan       settings in SamplingParams.extra_args, windows still rescanned
+  incremental  NoRepeatNGramBans: per-sequence rolling n-gram indexes
+
+Run from DeepSeek-OCR-vllm/:
+    python benchmarks/bench_ngram_bans.py [--seqs 64] [--steps 200] [--device cpu]
+"""
+import argparse
+import inspect
+import os
+import random
+import sys
+import time
+from array import array
+from types import SimpleNamespace
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process.ngram_norepeat import NO_REPEAT_NGRAM_ARG, NoRepeatNGramBans, NoRepeatNGramLogitsProcessor, no_repeat_ngram_args
+
+
+VOCAB_SIZE = 129280
+WHITELIST = {128821, 128822}
+
+
+class SettingsOnlyProcessor(NoRepeatNGramLogitsProcessor):
+    """The previous settings carrier: a no-op per-sequence call"""
+
+    def __call__(self, input_ids, scores):
+        return scores
+
+
+class SequenceData:
+    """The parts of vllm.sequence.SequenceData the bans read"""
+
+    def __init__(self, prompt_len):
+        self.prompt_token_ids = tuple(range(prompt_len))
+        self._output_token_ids = array("l")
+
+    @property
+    def output_token_ids(self):
+        return tuple(self._output_token_ids)
+
+    @property
+    def output_token_ids_array(self):
+        return self._output_token_ids
+
+
+def vllm_apply_logits_processors(logits, sampling_metadata):
+    """vLLM 0.8.5 V0 _apply_logits_processors without the optional thread pool"""
+    for seq_group in sampling_metadata.seq_groups:
+        logits_processors = seq_group.sampling_params.logits_processors
+        if logits_processors:
+            for seq_id, logits_row_idx in zip(seq_group.seq_ids, seq_group.sample_indices):
+                logits_row = logits[logits_row_idx]
+                past_tokens_ids = seq_group.seq_data[seq_id].output_token_ids
+                prompt_tokens_ids = seq_group.seq_data[seq_id].prompt_token_ids
+                for logits_processor in logits_processors:
+                    parameters = inspect.signature(logits_processor).parameters
+                    if len(parameters) == 3:
+                        logits_row = logits_processor(prompt_tokens_ids, past_tokens_ids, logits_row)
+                    else:
+                        logits_row = logits_processor(past_tokens_ids, logits_row)
+                logits[logits_row_idx] = logits_row
+    return logits
+
+
+def ban_in_windows(logits, row_indices, sequences, ngram_size, window_size, whitelist):
+    """The previous batched bans: unfold every window and match its n-gram prefixes"""
+    windows = []
+    active_rows = []
+    for row_idx, input_ids in zip(row_indices, sequences):
+        if len(input_ids) < ngram_size:
+            continue
+        tail = list(input_ids[-window_size:])
+        windows.append([-1] * (window_size - len(tail)) + tail)
+        active_rows.append(row_idx)
+    if not windows:
+        return
+
+    device = logits.device
+    tokens = torch.tensor(windows, dtype=torch.long, device=device)
+    ngrams = tokens.unfold(1, ngram_size, 1)
+    current_prefix = tokens[:, window_size - ngram_size + 1:]
+    matches = (ngrams[..., :-1] == current_prefix.unsqueeze(1)).all(dim=-1)
+    candidates = ngrams[..., -1]
+    if whitelist:
+        allowed = torch.tensor(sorted(whitelist), dtype=torch.long, device=device)
+        matches &= ~torch.isin(candidates, allowed)
+    rows = torch.tensor(active_rows, dtype=torch.long, device=device).unsqueeze(1).expand_as(candidates)
+    logits[rows[matches], candidates[matches]] = -float("inf")
+
+
+def processor_bans(logits, sampling_metadata):
+    logits = vllm_apply_logits_processors(logits, sampling_metadata)
+    groups = {}
+    for seq_group in sampling_metadata.seq_groups:
+        for processor in seq_group.sampling_params.logits_processors or ():
+            key = (processor.ngram_size, processor.window_size, frozenset(processor.whitelist_token_ids))
+            row_indices, sequences = groups.setdefault(key, ([], []))
+            for seq_id, row_idx in zip(seq_group.seq_ids, seq_group.sample_indices):
+                row_indices.append(row_idx)
+                sequences.append(seq_group.seq_data[seq_id].output_token_ids)
+    for (ngram_size, window_size, whitelist), (row_indices, sequences) in groups.items():
+        ban_in_windows(logits, row_indices, sequences, ngram_size, window_size, whitelist)
+    return logits
+
+
+def rescan_bans(logits, sampling_metadata):
+    groups = {}
+    for seq_group in sampling_metadata.seq_groups:
+        settings = seq_group.sampling_params.extra_args[NO_REPEAT_NGRAM_ARG]
+        row_indices, sequences = groups.setdefault(settings, ([], []))
+        for seq_id, row_idx in zip(seq_group.seq_ids, seq_group.sample_indices):
+            row_indices.append(row_idx)
+            sequences.append(seq_group.seq_data[seq_id].output_token_ids_array)
+    for (ngram_size, window_size, whitelist), (row_indices, sequences) in groups.items():
+        ban_in_windows(logits, row_indices, sequences, ngram_size, window_size, set(whitelist))
+    return logits
+
+
+def token_stream(rng, length, num_phrases=8, phrase_len=8):
+    """OCR-like output: a few phrases repeated in random order, so n-grams recur"""
+    phrases = [[rng.randrange(VOCAB_SIZE) for _ in range(phrase_len)] for _ in range(num_phrases)]
+    tokens = []
+    while len(tokens) < length:
+        tokens.extend(rng.choice(phrases))
+    return tokens[:length]
+
+
+def sampling_metadata(num_seqs, prompt_len, sampling_params):
+    seq_groups = [
+        SimpleNamespace(seq_ids=[seq_id], sample_indices=[seq_id], sampling_params=sampling_params,
+                        seq_data={seq_id: SequenceData(prompt_len)})
+        for seq_id in range(num_seqs)
+    ]
+    return SimpleNamespace(seq_groups=seq_groups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seqs", type=int, default=64)
+    parser.add_argument("--start-len", type=int, default=1000, help="output tokens before the timed steps")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--ngram-size", type=int, default=20)
+    parser.add_argument("--window-size", type=int, default=50)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    streams = [token_stream(rng, args.start_len + args.steps) for _ in range(args.seqs)]
+    processor_params = SimpleNamespace(
+        logits_processors=[SettingsOnlyProcessor(args.ngram_size, args.window_size, WHITELIST)], extra_args=None)
+    extra_args_params = SimpleNamespace(
+        logits_processors=[], extra_args=no_repeat_ngram_args(args.ngram_size, args.window_size, WHITELIST))
+    incremental = NoRepeatNGramBans()
+    paths = [
+        ("processor", processor_bans, sampling_metadata(args.seqs, 1000, processor_params)),
+        ("rescan", rescan_bans, sampling_metadata(args.seqs, 1000, extra_args_params)),
+        ("incremental", incremental, sampling_metadata(args.seqs, 1000, extra_args_params)),
+    ]
+
+    base = torch.randn(args.seqs, VOCAB_SIZE, device=args.device)
+    timings = {name: 0.0 for name, _, _ in paths}
+    banned = 0
+    for step in range(args.steps):
+        length = args.start_len + step + 1
+        for _, _, metadata in paths:
+            for seq_group, stream in zip(metadata.seq_groups, streams):
+                data = seq_group.seq_data[seq_group.seq_ids[0]]
+                data._output_token_ids.extend(stream[len(data._output_token_ids):length])
+
+        outputs = {}
+        for name, apply, metadata in paths:
+            logits = base.clone()
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            outputs[name] = apply(logits, metadata)
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            timings[name] += time.perf_counter() - start
+        for name in ("rescan", "incremental"):
+            assert torch.equal(outputs["processor"], outputs[name]), f"step {step}: {name} bans differ"
+        banned += int(torch.isinf(outputs["incremental"]).sum())
+
+    print(f"{args.seqs} sequences, {args.start_len} -> {args.start_len + args.steps} output tokens, "
+          f"ngram {args.ngram_size}, window {args.window_size}, {args.device}; {banned} bans")
+    print(f"{'path':>12} {'ms/step':>10}")
+    for name, total in timings.items():
+        print(f"{name:>12} {total / args.steps * 1e3:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Per-page time of PDF rasterization, PNG round-trip vs raw pixmap samples.
+
+The previous path encoded every rendered pixmap to PNG (pix.tobytes("png"))
+and decoded it again with Image.open; the new one (pixmap_to_image in
+api/utils/pdf_utils.py, same code in run_dpsk_ocr_pdf.py) builds the RGB
+image straight from the sample buffer. Rendering itself is timed separately,
+and both paths are checked to give identical pixels.
+
+Without --pdf a synthetic multi-page document (text, vector shapes and an
+embedded photo-like image per page) is generated in memory.
+
+With --scanned the pages are full-page 300 dpi JPEG scans instead, and
+rendering is compared with taking each page from its embedded image
+(PDF_EXTRACT_EMBEDDED, _embedded_page_image in pdf_utils), each on a freshly
+opened document so neither benefits from MuPDF's image cache.
+
+Run from DeepSeek-OCR-vllm/:
+    python benchmarks/bench_pdf_render.py [--pdf input/P0331.pdf --dpi 144 --pages 10]
+    python benchmarks/bench_pdf_render.py --scanned [--dpi 144 --pages 10]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import fitz
+import numpy as np
+from PIL import Image, ImageDraw
+
+# repository root, for the API's pdf_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+
+from api.utils.pdf_utils import _embedded_page_image, pixmap_to_image
+
+
+def sample_pdf(pages):
+    rng = np.random.default_rng(0)
+    photo = Image.fromarray(rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)).resize((800, 600))
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=90)
+
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page(width=595, height=842)  # A4 in points
+        for line in range(40):
+            page.insert_text((50, 60 + line * 12), f"Page {page_num + 1}, line {line + 1}: " + "lorem ipsum dolor sit amet " * 3, fontsize=8)
+        page.draw_rect(fitz.Rect(50, 560, 545, 790), color=(0, 0, 0), fill=(0.9, 0.9, 1.0))
+        page.insert_image(fitz.Rect(300, 580, 530, 770), stream=buffer.getvalue())
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def scanned_pdf(pages):
+    scan = Image.new("L", (2550, 3300), 255)  # letter at 300 dpi
+    draw = ImageDraw.Draw(scan)
+    for line in range(120):
+        draw.text((150, 100 + line * 26), f"scanned line {line + 1}: " + "lorem ipsum dolor sit amet " * 5, fill=0)
+    buffer = io.BytesIO()
+    scan.convert("RGB").save(buffer, format="JPEG", quality=85)
+
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page(width=612, height=792)
+        page.insert_image(page.rect, stream=buffer.getvalue(), keep_proportion=False)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def bench_scanned(pdf_bytes, dpi):
+    zoom = dpi / 72.0
+    mat = fitz.Matrix(zoom, zoom)
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    start = time.perf_counter()
+    rendered = [pixmap_to_image(page.get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False)) for page in doc]
+    render = time.perf_counter() - start
+    doc.close()
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    start = time.perf_counter()
+    extracted = [_embedded_page_image(page, (zoom, zoom)) for page in doc]
+    extract = time.perf_counter() - start
+    doc.close()
+
+    pages = len(rendered)
+    taken = [image for image in extracted if image is not None]
+    print(f"{pages} pages at {dpi} dpi, {len(taken)} taken from their embedded image")
+    print(f"{'step':>22} {'ms/page':>9} {'size':>11}")
+    print(f"{'render':>22} {render / pages * 1e3:>9.2f} {'x'.join(map(str, rendered[0].size)):>11}")
+    if taken:
+        size = "x".join(map(str, taken[0].size))
+        print(f"{'embedded image':>22} {extract / pages * 1e3:>9.2f} {size:>11}")
+        diff = np.abs(np.asarray(taken[0].resize(rendered[0].size), dtype=np.int16) - np.asarray(rendered[0], dtype=np.int16))
+        print(f"mean abs difference to the rendered page (first page): {diff.mean():.2f}")
+
+
+def png_round_trip(pix):
+    return Image.open(io.BytesIO(pix.tobytes("png"))).convert("RGB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", default=None, help="PDF to render (default: synthetic document)")
+    parser.add_argument("--pages", type=int, default=10, help="pages of the synthetic document")
+    parser.add_argument("--dpi", type=int, default=144)
+    parser.add_argument("--scanned", action="store_true", help="compare rendering with embedded image extraction")
+    args = parser.parse_args()
+
+    if args.pdf is not None:
+        with open(args.pdf, "rb") as f:
+            pdf_bytes = f.read()
+    elif args.scanned:
+        pdf_bytes = scanned_pdf(args.pages)
+    else:
+        pdf_bytes = sample_pdf(args.pages)
+
+    if args.scanned:
+        bench_scanned(pdf_bytes, args.dpi)
+        return
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    zoom = args.dpi / 72.0
+    mat = fitz.Matrix(zoom, zoom)
+
+    render = png = raw = 0.0
+    for page in doc:
+        start = time.perf_counter()
+        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False)
+        render += time.perf_counter() - start
+
+        start = time.perf_counter()
+        old = png_round_trip(pix)
+        old.load()
+        png += time.perf_counter() - start
+
+        start = time.perf_counter()
+        new = pixmap_to_image(pix)
+        raw += time.perf_counter() - start
+
+        assert np.array_equal(np.asarray(old), np.asarray(new)), f"page {page.number + 1}: pixels differ"
+    pages = len(doc)
+    size = f"{pix.width}x{pix.height}"
+    doc.close()
+
+    print(f"{pages} pages at {args.dpi} dpi ({size})")
+    print(f"{'step':>22} {'ms/page':>9}")
+    print(f"{'get_pixmap':>22} {render / pages * 1e3:>9.2f}")
+    print(f"{'PNG round-trip':>22} {png / pages * 1e3:>9.2f}")
+    print(f"{'raw samples':>22} {raw / pages * 1e3:>9.2f}")
+    print(f"{'page total old / new':>22} {(render + png) / pages * 1e3:>9.2f} / {(render + raw) / pages * 1e3:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+CPU time spent on position embeddings per vision encoder call, per view size.
+
+For one view the DeepEncoder resizes SAM's absolute pos_embed, builds the
+relative position tables of all 12 SAM attention blocks, and resizes CLIP's
+position table. This compares recomputing them on every call (previous
+behaviour) with the per-size memoized lookups, and checks that both give
+identical tensors.
+
+Run from DeepSeek-OCR-vllm/:
+    python benchmarks/bench_pos_embed.py [--repeat 50]
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deepencoder.clip_sdpa import CLIPVisionEmbeddings, get_abs_pos as clip_abs_pos, vit_model_cfg
+from deepencoder.sam_vary_sdpa import build_sam_vit_b, get_abs_pos as sam_abs_pos, get_rel_pos
+
+
+# view side in pixels -> (SAM grid size, CLIP token count)
+VIEW_SIZES = {
+    512: (32, 8 * 8 + 1),
+    640: (40, 10 * 10 + 1),
+    1024: (64, 16 * 16 + 1),
+    1280: (80, 20 * 20 + 1),
+}
+
+
+def attention_sizes(sam, grid):
+    """(module, q_size) of every SAM attention layer for a grid x grid input"""
+    sizes = []
+    for block in sam.blocks:
+        side = block.window_size if block.window_size > 0 else grid
+        sizes.append((block.attn, (side, side)))
+    return sizes
+
+
+def positions_uncached(sam, clip, grid, tokens):
+    outputs = [sam_abs_pos(sam.pos_embed, grid)]
+    for attn, size in attention_sizes(sam, grid):
+        outputs.append(get_rel_pos(size[0], size[0], attn.rel_pos_h))
+        outputs.append(get_rel_pos(size[1], size[1], attn.rel_pos_w))
+    outputs.append(clip_abs_pos(clip.position_embedding(clip.position_ids), tokens))
+    return outputs
+
+
+def positions_cached(sam, clip, grid, tokens):
+    outputs = [sam.abs_pos(grid)]
+    for attn, size in attention_sizes(sam, grid):
+        outputs.extend(attn.rel_pos(size, size))
+    outputs.append(clip.abs_pos(tokens))
+    return outputs
+
+
+def time_per_call(func, repeat):
+    func()  # warm-up (fills the caches)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--dtype", default="bfloat16", choices=["float32", "bfloat16"])
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    dtype = getattr(torch, args.dtype)
+    sam = build_sam_vit_b().to(dtype)
+    clip = CLIPVisionEmbeddings(hidden_size=vit_model_cfg.hidden_size, image_size=vit_model_cfg.image_size,
+                                patch_size=vit_model_cfg.patch_size).to(dtype)
+    for param in list(sam.parameters()) + list(clip.parameters()):
+        param.data.normal_()
+
+    print(f"{args.repeat} runs, {args.dtype}, {args.threads} thread(s)")
+    print(f"{'view':>6} {'uncached ms':>12} {'cached ms':>10} {'saved ms':>10}")
+    with torch.no_grad():
+        for side, (grid, tokens) in VIEW_SIZES.items():
+            expected = positions_uncached(sam, clip, grid, tokens)
+            actual = positions_cached(sam, clip, grid, tokens)
+            assert all(torch.equal(a, b) for a, b in zip(expected, actual)), f"{side}: cached positions differ"
+
+            uncached = time_per_call(lambda: positions_uncached(sam, clip, grid, tokens), args.repeat)
+            cached = time_per_call(lambda: positions_cached(sam, clip, grid, tokens), args.repeat)
+            print(f"{side:>6} {uncached * 1e3:>12.3f} {cached * 1e3:>10.3f} {(uncached - cached) * 1e3:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Per-image CPU time of the image part of DeepseekOCRProcessor, per resolution preset.
+
+Compares the previous path (PIL crop per tile, ToTensor + Normalize per tile,
+torch.stack, PIL-padded global view) with the vectorized one (one uint8 array,
+strided tile views, one normalize pass over the whole grid, global view padded
+in tensor space), and checks that both produce identical tensors.
+
+Run from DeepSeek-OCR-vllm/:
+    python benchmarks/bench_preprocess.py [--width 1654 --height 2339 --repeat 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process.image_process import (ImageGeometry, ImageTransform, dynamic_preprocess,
+                                   dynamic_preprocess_grid)
+
+try:
+    import torchvision.transforms as T
+except ImportError:
+    T = None
+
+
+PRESETS = {
+    "Tiny": ImageGeometry(base_size=512, image_size=512, crop_mode=False),
+    "Small": ImageGeometry(base_size=640, image_size=640, crop_mode=False),
+    "Base": ImageGeometry(base_size=1024, image_size=1024, crop_mode=False),
+    "Large": ImageGeometry(base_size=1280, image_size=1280, crop_mode=False),
+    "Gundam": ImageGeometry(base_size=1024, image_size=640, crop_mode=True),
+}
+
+MEAN = (0.5, 0.5, 0.5)
+STD = (0.5, 0.5, 0.5)
+PAD_COLOR = tuple(int(x * 255) for x in MEAN)
+
+
+def legacy_transform():
+    if T is not None:
+        return T.Compose([T.ToTensor(), T.Normalize(MEAN, STD)])
+
+    def transform(pic):
+        x = torch.from_numpy(np.array(pic)).permute(2, 0, 1).contiguous().float().div(255)
+        return x.sub_(torch.tensor(MEAN).view(-1, 1, 1)).div_(torch.tensor(STD).view(-1, 1, 1))
+    return transform
+
+
+def uses_crops(image, geometry):
+    return geometry.crop_mode and (image.width > geometry.image_size or image.height > geometry.image_size)
+
+
+def resize_for_global_view(image, geometry):
+    if geometry.image_size <= 640 and not geometry.crop_mode:
+        return image.resize((geometry.image_size, geometry.image_size))
+    return image
+
+
+def preprocess_legacy(image, geometry, transform):
+    crops = None
+    if uses_crops(image, geometry):
+        tiles, _ = dynamic_preprocess(image, min_num=geometry.min_crops, max_num=geometry.max_crops,
+                                      image_size=geometry.image_size)
+        crops = torch.stack([transform(tile) for tile in tiles], dim=0)
+
+    global_view = ImageOps.pad(resize_for_global_view(image, geometry),
+                               (geometry.base_size, geometry.base_size), color=PAD_COLOR)
+    return transform(global_view), crops
+
+
+def preprocess_vectorized(image, geometry, transform):
+    crops = None
+    if uses_crops(image, geometry):
+        grid, _ = dynamic_preprocess_grid(image, min_num=geometry.min_crops, max_num=geometry.max_crops,
+                                          image_size=geometry.image_size)
+        crops = transform.batch(grid).flatten(0, 1)
+
+    global_view = transform.pad(resize_for_global_view(image, geometry),
+                                (geometry.base_size, geometry.base_size), color=PAD_COLOR)
+    return global_view, crops
+
+
+def time_per_image(func, repeat):
+    func()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=1654, help="input width (default: A4 page at 200 DPI)")
+    parser.add_argument("--height", type=int, default=2339)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=1, help="torch intra-op threads (1 = one preprocessing worker)")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8))
+
+    old_transform = legacy_transform()
+    new_transform = ImageTransform(mean=MEAN, std=STD)
+
+    print(f"input {args.width}x{args.height}, {args.repeat} runs, {args.threads} thread(s)")
+    print(f"{'preset':<8} {'tiles':>5} {'legacy ms':>10} {'grid ms':>10} {'saved ms':>10} {'speedup':>8}")
+    for name, geometry in PRESETS.items():
+        old_global, old_crops = preprocess_legacy(image, geometry, old_transform)
+        new_global, new_crops = preprocess_vectorized(image, geometry, new_transform)
+        assert torch.equal(old_global, new_global), f"{name}: global view differs"
+        assert (old_crops is None) == (new_crops is None), f"{name}: tiling differs"
+        if old_crops is not None:
+            assert torch.equal(old_crops, new_crops), f"{name}: tiles differ"
+
+        legacy = time_per_image(lambda: preprocess_legacy(image, geometry, old_transform), args.repeat)
+        vectorized = time_per_image(lambda: preprocess_vectorized(image, geometry, new_transform), args.repeat)
+        tiles = 0 if new_crops is None else new_crops.shape[0]
+        print(f"{name:<8} {tiles:>5} {legacy * 1e3:>10.2f} {vectorized * 1e3:>10.2f} "
+              f"{(legacy - vectorized) * 1e3:>10.2f} {legacy / vectorized:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
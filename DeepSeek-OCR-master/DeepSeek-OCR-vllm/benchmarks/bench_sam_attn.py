@@ -0,0 +1,102 @@
+"""
+Peak CPU memory and time of one SAM global-attention layer, dense vs query-chunked bias.
+
+The dense path builds the whole (B, nHead, H*W, H*W) relative-position bias
+before scaled_dot_product_attention; the chunked path (Attention.chunk_size /
+config.SAM_ATTN_CHUNK) only builds chunk_size query rows of it at a time.
+Each configuration runs in a fresh process so its peak RSS growth can be read
+from getrusage, and every chunked output is checked against the dense one.
+
+Run from DeepSeek-OCR-vllm/:
+    python benchmarks/bench_sam_attn.py [--batch 1 --chunks 0 2048 1024 512]
+"""
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deepencoder.sam_vary_sdpa import Attention
+
+
+# view side in pixels -> SAM grid size (16 px patches)
+VIEW_SIZES = {
+    1024: 64,
+    1280: 80,
+}
+
+EMBED_DIM = 768
+NUM_HEADS = 12
+
+
+def build_inputs(grid, batch, dtype):
+    torch.manual_seed(0)
+    attn = Attention(EMBED_DIM, num_heads=NUM_HEADS, use_rel_pos=True, input_size=(64, 64))
+    for param in attn.parameters():
+        param.data.normal_(std=0.02)
+    x = torch.randn(batch, grid, grid, EMBED_DIM)
+    return attn.to(dtype), x.to(dtype)
+
+
+def max_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(grid, batch, dtype, chunk_size, repeat, queue):
+    torch.set_num_threads(1)
+    attn, x = build_inputs(grid, batch, getattr(torch, dtype))
+    attn.chunk_size = chunk_size
+    with torch.no_grad():
+        attn.rel_pos((grid, grid), (grid, grid))  # keep the cached tables out of the peak
+        before = max_rss_mb()
+        out = attn(x)
+        peak = max_rss_mb() - before
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            attn(x)
+        elapsed = (time.perf_counter() - start) / repeat
+    queue.put((peak, elapsed, out))
+
+
+def measure(grid, batch, dtype, chunk_size, repeat):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run, args=(grid, batch, dtype, chunk_size, repeat, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[0, 2048, 1024, 512])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "bfloat16"])
+    args = parser.parse_args()
+
+    atol = 1e-5 if args.dtype == "float32" else 1e-2
+    print(f"batch {args.batch}, {args.dtype}, {args.repeat} runs, 1 thread")
+    print(f"{'view':>6} {'chunk':>6} {'peak MB':>9} {'ms':>9} {'max diff':>10}")
+    for side, grid in VIEW_SIZES.items():
+        reference = None
+        for chunk_size in args.chunks:
+            peak, elapsed, out = measure(grid, args.batch, args.dtype, chunk_size, args.repeat)
+            if reference is None:
+                reference = out
+            diff = (out.float() - reference.float()).abs().max().item()
+            assert diff <= atol, f"{side}/{chunk_size}: chunked output differs by {diff}"
+            label = chunk_size if chunk_size > 0 else "dense"
+            print(f"{side:>6} {label:>6} {peak:>9.1f} {elapsed * 1e3:>9.1f} {diff:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,15 @@ MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
+MAX_VISION_BATCH = 16 # views (global views or tiles) per vision encoder call when images are encoded together
+SAM_ATTN_CHUNK = 0 # query rows per chunk in SAM global attention; 0 builds the full relative-position bias (fastest), 1024 cuts its peak memory at 1024/1280 views
 PRINT_NUM_VIS_TOKENS = False
 SKIP_REPEAT = True
+STOP_ON_REPEAT = True # stop a sequence as soon as its output loops (checked online) instead of decoding up to max_tokens
+PIXEL_TRANSPORT = 'float32' # 'uint8': ship raw HWC pixels to the model and normalize on the GPU (4x less host memory / IPC)
+EMBED_CACHE_MB = 512 # host memory for vision features of recently seen images (same page, several prompts); 0 disables
+EMBED_CACHE_SPILL_DIR = None # directory for features evicted from memory (memory-mapped .npy files); None disables
+EMBED_CACHE_SPILL_MB = 4096
 MODEL_PATH = 'deepseek_ocr/' # change to your model path
 
 # TODO: change INPUT_PATH
@@ -127,6 +127,25 @@ class CLIPVisionEmbeddings(nn.Module):
         self.register_buffer(
             "position_ids", torch.arange(self.num_positions).expand((1, -1))
         )
+        # interpolated position embeddings per (num_tokens, dtype, device)
+        self._abs_pos_cache = {}
+
+    def clear_pos_cache(self):
+        """Drop memoized position embeddings (call after the weights change)"""
+        self._abs_pos_cache.clear()
+
+    def abs_pos(self, num_tokens):
+        """get_abs_pos of the position table for num_tokens, interpolated once per size in inference"""
+        if torch.is_grad_enabled():
+            return get_abs_pos(self.position_embedding(self.position_ids), num_tokens)
+
+        weight = self.position_embedding.weight
+        key = (num_tokens, weight.dtype, weight.device)
+        pos = self._abs_pos_cache.get(key)
+        if pos is None:
+            pos = get_abs_pos(self.position_embedding(self.position_ids), num_tokens)
+            self._abs_pos_cache[key] = pos
+        return pos
 
     def forward(self, pixel_values, patch_embeds):
         batch_size = pixel_values.shape[0]
@@ -151,7 +170,7 @@ class CLIPVisionEmbeddings(nn.Module):
         embeddings = torch.cat([class_embeds, patch_embeds], dim=1)
 
         # x = torch.cat([cls_token, x], dim=1)
-        embeddings = embeddings + get_abs_pos(self.position_embedding(self.position_ids), embeddings.size(1))
+        embeddings = embeddings + self.abs_pos(embeddings.size(1))
         # embeddings = embeddings + self.position_embedding(self.position_ids)
         return embeddings
 
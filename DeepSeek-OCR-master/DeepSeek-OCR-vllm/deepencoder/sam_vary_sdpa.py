@@ -93,6 +93,7 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        attn_chunk_size: int = 0,
     ) -> None:
         """
         Args:
@@ -111,6 +112,8 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            attn_chunk_size (int): Query rows per attention chunk when the relative position
+                bias is added (0 materializes the whole bias at once).
         """
         super().__init__()
         self.img_size = img_size
@@ -142,6 +145,7 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attn_chunk_size=attn_chunk_size,
             )
             self.blocks.append(block)
 
@@ -166,11 +170,30 @@ class ImageEncoderViT(nn.Module):
         self.net_2 = nn.Conv2d(256, 512, kernel_size=3, stride=2, padding=1, bias=False)
         self.net_3 = nn.Conv2d(512, 1024, kernel_size=3, stride=2, padding=1, bias=False)
 
+        # interpolated pos_embed per (grid size, dtype, device)
+        self._abs_pos_cache = {}
+
+    def clear_pos_cache(self):
+        """Drop memoized position embeddings (call after the weights change)"""
+        self._abs_pos_cache.clear()
+
+    def abs_pos(self, tgt_size: int) -> torch.Tensor:
+        """get_abs_pos of pos_embed for a tgt_size grid, interpolated once per size in inference"""
+        if torch.is_grad_enabled():
+            return get_abs_pos(self.pos_embed, tgt_size)
+
+        key = (tgt_size, self.pos_embed.dtype, self.pos_embed.device)
+        pos = self._abs_pos_cache.get(key)
+        if pos is None:
+            pos = get_abs_pos(self.pos_embed, tgt_size)
+            self._abs_pos_cache[key] = pos
+        return pos
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
             # x = x + self.pos_embed
-            x = x + get_abs_pos(self.pos_embed, x.size(1))
+            x = x + self.abs_pos(x.size(1))
 
         for blk in self.blocks:
             x = blk(x)
@@ -198,6 +221,7 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_chunk_size: int = 0,
     ) -> None:
         """
         Args:
@@ -213,6 +237,8 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_chunk_size (int): Query rows per attention chunk when the relative position
+                bias is added (0 materializes the whole bias at once).
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -223,6 +249,7 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            chunk_size=attn_chunk_size,
         )
 
         self.norm2 = norm_layer(dim)
@@ -260,6 +287,7 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        chunk_size: int = 0,
     ) -> None:
         """
         Args:
@@ -270,9 +298,13 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            chunk_size (int): Query rows per attention chunk when the relative position bias
+                is added, so only a (B, nHead, chunk_size, H * W) slice of the bias exists at a
+                time. 0 materializes the whole (B, nHead, H * W, H * W) bias at once.
         """
         super().__init__()
         self.num_heads = num_heads
+        self.chunk_size = chunk_size
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
 
@@ -288,6 +320,27 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        # (Rh, Rw) per (q_size, k_size, dtype, device)
+        self._rel_pos_cache = {}
+
+    def clear_pos_cache(self):
+        """Drop memoized relative position embeddings (call after the weights change)"""
+        self._rel_pos_cache.clear()
+
+    def rel_pos(self, q_size: Tuple[int, int], k_size: Tuple[int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """get_rel_pos for both axes, resized and indexed once per size in inference"""
+        if torch.is_grad_enabled():
+            return (get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                    get_rel_pos(q_size[1], k_size[1], self.rel_pos_w))
+
+        key = (q_size, k_size, self.rel_pos_h.dtype, self.rel_pos_h.device)
+        rel_pos = self._rel_pos_cache.get(key)
+        if rel_pos is None:
+            rel_pos = (get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                       get_rel_pos(q_size[1], k_size[1], self.rel_pos_w))
+            self._rel_pos_cache[key] = rel_pos
+        return rel_pos
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
@@ -297,7 +350,8 @@ class Attention(nn.Module):
 
         rel_h, rel_w = None, None
         if self.use_rel_pos:
-            rel_h, rel_w = add_decomposed_rel_pos(q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+            Rh, Rw = self.rel_pos((H, W), (H, W))
+            rel_h, rel_w = decomposed_rel_pos(q, Rh, Rw, (H, W), (H, W))
 
         q = q.view(B, self.num_heads, H * W, -1)
         k = k.view(B, self.num_heads, H * W, -1)
@@ -306,8 +360,11 @@ class Attention(nn.Module):
         if self.use_rel_pos:
             rel_h = rel_h.view(B, self.num_heads, rel_h.size(1), rel_h.size(2), rel_h.size(3))
             rel_w = rel_w.view(B, self.num_heads, rel_w.size(1), rel_w.size(2), rel_w.size(3))
-            attn_bias = (rel_h + rel_w).view(B, self.num_heads, rel_h.size(2), rel_h.size(3) * rel_w.size(4))
-            x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
+            if 0 < self.chunk_size < H * W:
+                x = chunked_rel_pos_attention(q, k, v, rel_h, rel_w, self.chunk_size)
+            else:
+                attn_bias = (rel_h + rel_w).view(B, self.num_heads, rel_h.size(2), rel_h.size(3) * rel_w.size(4))
+                x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
             # x = _attention_rel_h_rel_w(q, k, v, rel_h, rel_w)
         else:
             x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
@@ -432,6 +489,31 @@ def add_decomposed_rel_pos(
     Rh = get_rel_pos(q_h, k_h, rel_pos_h)
     Rw = get_rel_pos(q_w, k_w, rel_pos_w)
 
+    return decomposed_rel_pos(q, Rh, Rw, q_size, k_size)
+
+
+def decomposed_rel_pos(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    add_decomposed_rel_pos with the per-axis embeddings already extracted by get_rel_pos.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        Rh (Tensor): get_rel_pos(q_h, k_h, rel_pos_h) with shape (q_h, k_h, C).
+        Rw (Tensor): get_rel_pos(q_w, k_w, rel_pos_w) with shape (q_w, k_w, C).
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        rel_h, rel_w (Tensor): height and width attention biases.
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+
     B, _, dim = q.shape
     r_q = q.reshape(B, q_h, q_w, dim)
     rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
@@ -444,6 +526,42 @@ def add_decomposed_rel_pos(
     return rel_h, rel_w
 
 
+def chunked_rel_pos_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    rel_h: torch.Tensor,
+    rel_w: torch.Tensor,
+    chunk_size: int,
+) -> torch.Tensor:
+    """
+    scaled_dot_product_attention with the decomposed relative position bias, computed
+    chunk_size query rows at a time so the dense (q_len, k_h * k_w) bias is never built.
+    Args:
+        q (Tensor): query with shape (B, nHead, q_len, C).
+        k (Tensor): key with shape (B, nHead, k_h * k_w, C).
+        v (Tensor): value with shape (B, nHead, k_h * k_w, C).
+        rel_h (Tensor): height bias from decomposed_rel_pos with shape (B, nHead, q_len, k_h, 1).
+        rel_w (Tensor): width bias from decomposed_rel_pos with shape (B, nHead, q_len, 1, k_w).
+        chunk_size (int): query rows per chunk.
+
+    Returns:
+        x (Tensor): attention output with shape (B, nHead, q_len, C).
+    """
+    B, num_heads, q_len, _ = q.shape
+    k_len = rel_h.size(3) * rel_w.size(4)
+
+    x = q.new_empty(B, num_heads, q_len, v.size(-1))
+    for start in range(0, q_len, chunk_size):
+        end = min(start + chunk_size, q_len)
+        attn_bias = (rel_h[:, :, start:end] + rel_w[:, :, start:end]).view(B, num_heads, end - start, k_len)
+        x[:, :, start:end] = torch.nn.functional.scaled_dot_product_attention(
+            q[:, :, start:end], k, v, attn_mask=attn_bias
+        )
+
+    return x
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
@@ -478,13 +596,14 @@ class PatchEmbed(nn.Module):
         return x
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, attn_chunk_size=0):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        attn_chunk_size=attn_chunk_size,
     )
 
 
@@ -494,6 +613,7 @@ def _build_sam(
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    attn_chunk_size=0,
 ):
     prompt_embed_dim = 256
     image_size = 1024
@@ -512,6 +632,7 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
+            attn_chunk_size=attn_chunk_size,
         )
     
     if checkpoint is not None:
@@ -1,6 +1,7 @@
 
 """Inference-only Deepseek-OCR model compatible with HuggingFace weights."""
 import math
+from collections import OrderedDict
 from collections.abc import Iterable, Mapping, Sequence
 from typing import List, Literal, Optional, Set, Tuple, TypedDict, Union
 
@@ -27,8 +28,11 @@ from vllm.sequence import IntermediateTensors
 from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
-from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+from process.image_process import DeepseekOCRProcessor, ImageGeometry, ImageTransform, DEFAULT_GEOMETRY
+from process.tile_planner import TILE_PLANNER
+from process.ngram_norepeat import NoRepeatNGramBans
+from process.repetition_stop import apply_repetition_stop
+from process.embedding_cache import EmbeddingCache
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -42,10 +46,14 @@ from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MAX_VISION_BATCH, SAM_ATTN_CHUNK, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import EMBED_CACHE_MB, EMBED_CACHE_SPILL_DIR, EMBED_CACHE_SPILL_MB
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
+# (colour, view size) entries of encoder features kept for single-colour views
+UNIFORM_FEATURES_CACHE_SIZE = 64
+
 
 class DeepseekOCRProcessingInfo(BaseProcessingInfo):
 
@@ -62,48 +70,15 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              *,
                              image_width: int,
                              image_height: int,
-                             cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
-
-        # image_size = hf_processor.image_size
-        # patch_size = hf_processor.patch_size
-        # downsample_ratio = hf_processor.downsample_ratio
-
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
-        patch_size = 16
-        downsample_ratio = 4
-
-        if CROP_MODE:
-            if image_width <= 640 and image_height <= 640:
-                crop_ratio = [1, 1]
-            else:
-                # images_crop_raw, crop_ratio = hf_processor.dynamic_preprocess(image)
-
-                # find the closest aspect ratio to the target
-                crop_ratio = count_tiles(image_width, image_height, image_size=IMAGE_SIZE)
-
-                # print('===========')
-                # print('crop_ratio ', crop_ratio)
-                # print('============')
-                
-            num_width_tiles, num_height_tiles = crop_ratio
-        else:
-            num_width_tiles = num_height_tiles = 1
-
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
-        else:
-            local_views_tokens = 0
-
+                             cropping: bool = True,
+                             geometry: Optional[ImageGeometry] = None) -> int:
+        # geometry comes from the tokenized item (per-request resolution);
+        # fall back to the config defaults for profiling / plain images
+        if geometry is None:
+            geometry = DEFAULT_GEOMETRY._replace(crop_mode=cropping)
 
-        return global_views_tokens + local_views_tokens + 1
+        # same cached plan the processor used when tokenizing the item
+        return TILE_PLANNER.plan(image_width, image_height, geometry).num_image_tokens
 
     def get_image_size_with_most_features(self) -> ImageSize:
 
@@ -112,6 +87,14 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
         return ImageSize(width=640*2, height=640*2)
 
 
+def _has_images(images_spatial_crop) -> bool:
+    """False for the placeholder of tokenize_with_images without images (images_spatial_crop [..., 1] instead of [..., 2])"""
+    # a list when images of different geometries are batched
+    if isinstance(images_spatial_crop, list):
+        return any(_has_images(crop) for crop in images_spatial_crop)
+    return not isinstance(images_spatial_crop, torch.Tensor) or images_spatial_crop.shape[-1] == 2
+
+
 class DeepseekOCRDummyInputsBuilder(
         BaseDummyInputsBuilder[DeepseekOCRProcessingInfo]):
 
@@ -185,6 +168,9 @@ class DeepseekOCRMultiModalProcessor(
             images_spatial_crop=MultiModalFieldConfig.batched("image"),
             # image_embeds=MultiModalFieldConfig.batched("image2"),
             images_crop=MultiModalFieldConfig.batched("image"),
+            images_key=MultiModalFieldConfig.batched("image"),
+            images_color=MultiModalFieldConfig.batched("image"),
+            images_crop_color=MultiModalFieldConfig.batched("image"),
         )
 
     def _get_prompt_updates(
@@ -209,14 +195,15 @@ class DeepseekOCRMultiModalProcessor(
             else:
 
                 
-                width = images[0][-1][0][0]
-                height = images[0][-1][0][1]
+                # tokenized item: [..., image_shapes, geometries]
+                width, height = images[0][6][0]
+                geometry = images[0][7][0]
 
                 num_image_tokens = self.info.get_num_image_tokens(
                     image_width=width,
                     image_height=height,
-                    # flag = True,
-                    cropping=CROP_MODE,
+                    cropping=geometry.crop_mode,
+                    geometry=geometry,
                 )
             return [image_token_id] * num_image_tokens
 
@@ -285,13 +272,28 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         tokenizer = cached_tokenizer_from_config(model_config)
         self.image_token_id = tokenizer.vocab[_IMAGE_TOKEN]
 
-        self.sam_model = build_sam_vit_b()
+        self.sam_model = build_sam_vit_b(attn_chunk_size=SAM_ATTN_CHUNK)
         self.vision_model = build_clip_l()
 
         n_embed = 1280
         self.projector =  MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed))
         self.tile_tag = config.tile_tag
         self.global_view_pos = config.global_view_pos
+
+        # normalizes uint8 pixel transport inputs on the model device (processor mean/std)
+        self.image_transform = ImageTransform()
+
+        # vision features of recently encoded images, keyed by the processor's images_key
+        self.embedding_cache = (
+            EmbeddingCache(EMBED_CACHE_MB * 1024 * 1024, EMBED_CACHE_SPILL_DIR, EMBED_CACHE_SPILL_MB * 1024 * 1024)
+            if EMBED_CACHE_MB > 0 else None
+        )
+
+        # encoder features of single-colour views per (colour, height, width); blank margins are common
+        self._uniform_features = OrderedDict()
+
+        # per-sequence n-gram indexes for requests with no_repeat_ngram_args
+        self.ngram_bans = NoRepeatNGramBans()
     
         # self.sam_model = torch.compile(self.sam_model, mode="reduce-overhead")
         # self.vision_model = torch.compile(self.vision_model, mode="reduce-overhead")
@@ -336,9 +338,17 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values = kwargs.pop("pixel_values", None)
         images_spatial_crop = kwargs.pop("images_spatial_crop", None)
         images_crop = kwargs.pop("images_crop", None)
+        images_key = kwargs.pop("images_key", None)
+        images_color = kwargs.pop("images_color", None)
+        images_crop_color = kwargs.pop("images_crop_color", None)
+
 
+        if pixel_values is None:
+            return None
 
-        if pixel_values is None or torch.sum(pixel_values).item() == 0:
+        # the processor's image-less placeholder, told apart by shape: its
+        # pixels are zeros, and so is every black image under uint8 transport
+        if not _has_images(images_spatial_crop):
             return None
 
         if pixel_values is not None:
@@ -354,81 +364,198 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 raise ValueError("Incorrect type of image crop. "
                                  f"Got type: {type(images_crop)}")
 
-            return [pixel_values, images_crop, images_spatial_crop]
+            return [pixel_values, images_crop, images_spatial_crop, images_key, images_color, images_crop_color]
 
 
         raise AssertionError("This line should be unreachable.")
     
 
 
+    def _to_vision_dtype(self, pixels: torch.Tensor) -> torch.Tensor:
+        """Processor pixels -> normalized bfloat16 [..., 3, H, W]"""
+        if pixels.dtype == torch.uint8:
+            # uint8 pixel transport: raw HWC pixels, normalized here instead of on the CPU
+            return self.image_transform.batch_hwc(pixels).to(torch.bfloat16)
+        return pixels.to(torch.bfloat16)
+
+    def _encode_views(self, views: torch.Tensor) -> torch.Tensor:
+        """SAM + CLIP + projector over a batch of same-sized views: [N, 3, H, W] -> [N, hw, n_embed]"""
+        features_1 = self.sam_model(views)
+        features_2 = self.vision_model(views, features_1)
+        features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+        return self.projector(features)
+
+    def _encode_batched(self, views: List[torch.Tensor],
+                        colors: Optional[List[Optional[List[int]]]] = None) -> List[torch.Tensor]:
+        """
+        Encode per-image view stacks ([n_i, 3, H, W]) across images.
+
+        `colors` holds, per stack, the processor's uniform_colors code of each
+        view (or None). A single-colour view takes the features cached for its
+        colour and size instead of being encoded; the first view of a colour
+        and size is encoded and cached.
+        """
+        if colors is None or all(codes is None or max(codes, default=-1) < 0 for codes in colors):
+            return self._encode_stacks(views)
+
+        kept, reused, fresh = [], {}, {}  # kept view indices, (stack, view) -> key, key -> (stack, view)
+        for idx, (stack, codes) in enumerate(zip(views, colors)):
+            keep = []
+            for view_idx, code in enumerate(codes if codes is not None else [-1] * len(stack)):
+                key = (code, stack.shape[-2], stack.shape[-1])
+                if code >= 0 and (key in self._uniform_features or key in fresh):
+                    reused[(idx, view_idx)] = key
+                    continue
+                if code >= 0:
+                    fresh[key] = (idx, view_idx)
+                keep.append(view_idx)
+            kept.append(keep)
+
+        nonempty = [idx for idx, keep in enumerate(kept) if keep]
+        encoded = self._encode_stacks([views[idx] if len(kept[idx]) == len(views[idx])
+                                       else views[idx][kept[idx]] for idx in nonempty])
+        features = [None] * len(views)
+        for idx, stack_features in zip(nonempty, encoded):
+            if len(kept[idx]) == len(views[idx]):
+                features[idx] = stack_features
+            else:
+                features[idx] = stack_features.new_empty((len(views[idx]),) + stack_features.shape[1:])
+                features[idx][kept[idx]] = stack_features
+
+        for (idx, view_idx), key in reused.items():
+            if key in fresh:
+                cached = features[fresh[key][0]][fresh[key][1]]
+            else:
+                cached = self._uniform_features[key]
+                self._uniform_features.move_to_end(key)
+            if features[idx] is None:
+                features[idx] = cached.new_empty((len(views[idx]),) + cached.shape)
+            features[idx][view_idx] = cached
+
+        for key, (idx, view_idx) in fresh.items():
+            self._uniform_features[key] = features[idx][view_idx].clone()
+            if len(self._uniform_features) > UNIFORM_FEATURES_CACHE_SIZE:
+                self._uniform_features.popitem(last=False)
+        return features
+
+    def _encode_stacks(self, views: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        Run the encoder over per-image view stacks ([n_i, 3, H, W]) across images.
+
+        Stacks of the same size are concatenated and encoded together, at
+        most MAX_VISION_BATCH views per encoder call; the features are split
+        back per input.
+        """
+        by_shape = {}
+        for idx, stack in enumerate(views):
+            by_shape.setdefault(tuple(stack.shape[1:]), []).append(idx)
+
+        features = [None] * len(views)
+        for indices in by_shape.values():
+            stacks = [views[idx] for idx in indices]
+            batch = stacks[0] if len(stacks) == 1 else torch.cat(stacks, dim=0)
+            encoded = torch.cat([self._encode_views(chunk) for chunk in batch.split(MAX_VISION_BATCH)], dim=0)
+            for idx, feature in zip(indices, encoded.split([len(stack) for stack in stacks])):
+                features[idx] = feature
+        return features
+
+    def _view_colors(self, images_color, images_crop_color, indices: List[int], crop_shapes: List[List[int]]):
+        """Colour codes of the global views and the tile stacks of the images at indices, in one host transfer"""
+        if images_color is None or images_crop_color is None or not indices:
+            return None, None
+        has_crops = [crop_shapes[idx][0] > 1 or crop_shapes[idx][1] > 1 for idx in indices]
+        crop_colors = [images_crop_color[idx][0] for idx, crops in zip(indices, has_crops) if crops]
+        codes = torch.cat([torch.stack([images_color[idx][0] for idx in indices])] + crop_colors).tolist()
+
+        global_colors = [[code] for code in codes[:len(indices)]]
+        local_colors, offset = [], len(indices)
+        for colors in crop_colors:
+            local_colors.append(codes[offset:offset + len(colors)])
+            offset += len(colors)
+        return global_colors, local_colors
+
+    def _embedding_keys(self, images_key, num_images: int) -> List[Optional[bytes]]:
+        """Per-image embedding cache keys (None = not cacheable)"""
+        if self.embedding_cache is None or images_key is None:
+            return [None] * num_images
+        keys = torch.stack([image_key[0] for image_key in images_key]).cpu().numpy()
+        return [key.tobytes() if key.any() else None for key in keys]
+
     def _pixel_values_to_embedding(
         self,
         pixel_values: torch.Tensor,
         images_crop: torch.Tensor,
         images_spatial_crop: torch.Tensor,
+        images_key: Optional[torch.Tensor] = None,
+        images_color: Optional[torch.Tensor] = None,
+        images_crop_color: Optional[torch.Tensor] = None,
     ) -> NestedTensors:
 
         # Pixel_values (global view): [n_image, batch_size, 3, height, width]
         # images_spatial_crop: [n_image, batch_size, [num_tiles_w, num_tiles_h]]
         # images_crop (local view): [n_image, batch_size, num_pathes, 3, h, w]
+        # images_key: [n_image, batch_size, 16] embedding cache keys (all zero = uncached)
+        # images_color / images_crop_color: [n_image, batch_size] / [n_image, batch_size, num_pathes]
+        #   colour codes of single-colour views (-1 = not one colour)
         # split the pixel and image_crop, all batch_size = 1
-
-        images_in_this_batch = []
-
-
-        # print(type(images_crop))
-
-        # print(pixel_values.shape)
-
+        #
+        # Each argument is either a batched tensor or, when the images in this
+        # batch use different geometries, a list of per-image tensors.
+
+        # one host transfer for the whole batch; (1, 1) means no local views
+        crop_shapes = torch.stack([spatial_crop[0] for spatial_crop in images_spatial_crop]).tolist()
+
+        # cached images skip the encoder; repeats of one image in the batch are encoded once
+        keys = self._embedding_keys(images_key, len(crop_shapes))
+        images_in_this_batch = [None] * len(crop_shapes)
+        to_encode, first_seen = [], {}
+        for idx, key in enumerate(keys):
+            if key is not None:
+                if key in first_seen:
+                    continue
+                first_seen[key] = idx
+                images_in_this_batch[idx] = self.embedding_cache.get(key, device=self.image_newline.device)
+            if images_in_this_batch[idx] is None:
+                to_encode.append(idx)
 
         with torch.no_grad():
-            for jdx in range(images_spatial_crop.size(0)):
-                # with torch.set_grad_enabled(False):
-                patches = images_crop[jdx][0].to(torch.bfloat16) # batch_size = 1
-                image_ori = pixel_values[jdx]
-                crop_shape = images_spatial_crop[jdx][0]
+            global_views = [self._to_vision_dtype(pixel_values[idx]) for idx in to_encode]
+            local_views = [self._to_vision_dtype(images_crop[idx][0]) # batch_size = 1
+                           for idx in to_encode
+                           if crop_shapes[idx][0] > 1 or crop_shapes[idx][1] > 1]
 
-                if torch.sum(patches).item() != 0:  # if all values = 0, no crop
-                    # P, C, H, W = patches.shape
-                    # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
+            global_colors, local_colors = self._view_colors(images_color, images_crop_color, to_encode, crop_shapes)
 
+            # all global views in one pass, all tiles of all images in another
+            global_features_list = self._encode_batched(global_views, global_colors)
+            local_features_list = iter(self._encode_batched(local_views, local_colors))
 
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
+            for idx, global_features in zip(to_encode, global_features_list):
+                width_crop_num, height_crop_num = crop_shapes[idx]
+                has_crops = width_crop_num > 1 or height_crop_num > 1
+                local_features = next(local_features_list) if has_crops else None
 
+                if PRINT_NUM_VIS_TOKENS:
+                    print('=====================')
+                    print('BASE: ', global_features.shape)
+                    print('PATCHES: ', local_features.shape if has_crops else 'NO PATCHES')
+                    print('=====================')
 
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                _, hw, n_dim = global_features.shape
+                h = w = int(hw ** 0.5)
 
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('PATCHES: ', local_features.shape)
-                        print('=====================')
+                global_features = global_features.view(h, w, n_dim)
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
+                global_features = torch.cat(
+                    [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
+                )
+
+                global_features = global_features.view(-1, n_dim)
 
+                if has_crops:
                     _2, hw2, n_dim2 = local_features.shape
                     h2 = w2 = int(hw2 ** 0.5)
 
-                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
-
                     local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
                     local_features = torch.cat(
                         [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1
@@ -436,33 +563,16 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     local_features = local_features.view(-1, n_dim2)
 
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
-                
                 else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
-
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('NO PATCHES')
-                        print('=====================')
-
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
                     global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
-                images_in_this_batch.append(global_local_features)
+                images_in_this_batch[idx] = global_local_features
+                if keys[idx] is not None:
+                    self.embedding_cache.put(keys[idx], global_local_features)
+
+        for idx, key in enumerate(keys):
+            if images_in_this_batch[idx] is None:
+                images_in_this_batch[idx] = images_in_this_batch[first_seen[key]]
 
         return images_in_this_batch
 
@@ -470,9 +580,9 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
             self, image_input) -> torch.Tensor:
         
 
-        # image_input: [pixel_values, images_crop, images_spatial_crop]
+        # image_input: [pixel_values, images_crop, images_spatial_crop, images_key, images_color, images_crop_color]
     
-        pixel_values = image_input[0].to(torch.bfloat16)
+        pixel_values = image_input[0]
         # print(image_input[1][0].shape)
         # print(type(image_input[1]))
         # exit()
@@ -480,11 +590,13 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         # images_crop = image_input[1].to(torch.bfloat16)
         images_crop = image_input[1]
         # images_crop = image_input[1]
-        images_spatial_crop = image_input[2].to(dtype=torch.long)
+        images_spatial_crop = image_input[2]
+        images_key = image_input[3]
 
         # local_start = time.time()
         vision_features = self._pixel_values_to_embedding(
-            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop)
+            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop,
+            images_key=images_key, images_color=image_input[4], images_crop_color=image_input[5])
 
         # local_total_time = time.time() - local_start
 
@@ -557,8 +669,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         hidden_states: torch.Tensor,
         sampling_metadata: SamplingMetadata,
     ) -> Optional[torch.Tensor]:
-        return self.language_model.compute_logits(hidden_states,
-                                                  sampling_metadata)
+        logits = self.language_model.compute_logits(hidden_states,
+                                                    sampling_metadata)
+        # Batched n-gram bans for sequences with no_repeat_ngram_args
+        if logits is not None:
+            logits = self.ngram_bans(logits, sampling_metadata)
+            # after the bans: a looping sequence may only emit its stop token
+            logits = apply_repetition_stop(logits, sampling_metadata)
+        return logits
 
 
     def load_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]) -> Set[str]:
@@ -575,6 +693,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         loader = AutoWeightsLoader(self)
         autoloaded_weights = loader.load_weights(processed_weights, mapper=self.hf_to_vllm_mapper)
 
+        # position embeddings interpolated before loading are stale now
+        for module in self.modules():
+            if hasattr(module, "clear_pos_cache"):
+                module.clear_pos_cache()
+        if self.embedding_cache is not None:
+            self.embedding_cache.clear()
+        self._uniform_features.clear()
+
 
 
 
@@ -0,0 +1,215 @@
+import atexit
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+# Bump when the vision features for identical pixels may change
+EMBEDDING_KEY_VERSION = b"vision-embedding-v1"
+
+# Bytes per image key carried from the processor to the model
+EMBEDDING_KEY_SIZE = 16
+
+# Lookups between two log lines with the cache stats
+STATS_LOG_INTERVAL = 1000
+
+# Same-sized integer dtypes used to store features numpy cannot represent (bfloat16)
+_STORAGE_DTYPES = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+def hash_image(image) -> str:
+    """Digest of the decoded RGB pixels of a PIL image (or [H, W, 3] uint8 array), as the API result cache computes it"""
+    pixels = np.ascontiguousarray(np.asarray(image))
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(repr(pixels.shape).encode('ascii'))
+    digest.update(pixels.data)
+    return digest.hexdigest()
+
+
+def embedding_key(pixel_digest: str, geometry, pixel_transport: str) -> bytes:
+    """Cache key of one image's vision features: pixels + everything that shapes the encoder input"""
+    digest = hashlib.blake2b(digest_size=EMBEDDING_KEY_SIZE)
+    digest.update(EMBEDDING_KEY_VERSION)
+    digest.update(repr(tuple(geometry)).encode('utf-8'))
+    digest.update(pixel_transport.encode('ascii'))
+    digest.update(pixel_digest.encode('ascii'))
+    return digest.digest()
+
+
+class _SpillTier:
+    """Size-bounded store of evicted features as .npy files, read back memory-mapped"""
+
+    def __init__(self, directory, max_bytes: int):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        # private per-process directory: features are only valid for the weights of this process
+        self.directory = Path(tempfile.mkdtemp(prefix="embeds-", dir=directory))
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[bytes, Tuple[int, torch.dtype]]" = OrderedDict()  # key -> (size, dtype)
+        atexit.register(shutil.rmtree, self.directory, True)
+
+    def _path(self, key: bytes) -> Path:
+        return self.directory / f"{key.hex()}.npy"
+
+    def _forget(self, key: bytes):
+        size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+        self._path(key).unlink(missing_ok=True)
+
+    def pop(self, key: bytes) -> Optional[torch.Tensor]:
+        """Load (and drop) a spilled entry; it moves back to the memory tier"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        _, dtype = entry
+        try:
+            # copy-on-write mapping: pages are read when the features are copied to the device
+            features = torch.from_numpy(np.load(self._path(key), mmap_mode='c')).view(dtype)
+        except OSError:
+            features = None
+        self._forget(key)
+        return features
+
+    def put(self, key: bytes, features: torch.Tensor):
+        size = features.numel() * features.element_size()
+        if size > self.max_bytes:
+            return
+        storage = features.view(_STORAGE_DTYPES[features.element_size()]).numpy()
+        try:
+            np.save(self._path(key), storage)
+        except OSError as e:
+            print(f"Warning: failed to spill vision embedding: {e}")
+            return
+        self._entries[key] = (size, features.dtype)
+        self.total_bytes += size
+
+        while self.total_bytes > self.max_bytes:
+            self._forget(next(iter(self._entries)))
+
+    def clear(self):
+        for key in list(self._entries):
+            self._forget(key)
+
+
+class EmbeddingCache:
+    """
+    LRU cache of per-image vision features (the global_local_features of
+    _pixel_values_to_embedding), bounded by bytes.
+
+    Entries live in (pinned) host memory and are moved to the model device
+    on a hit. Features computed on a CUDA device are copied to the host
+    without blocking the forward pass; an entry is stored once its copy has
+    completed. Entries evicted from memory spill to memory-mapped .npy files
+    when a spill directory is configured.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir=None, spill_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._memory: "OrderedDict[bytes, torch.Tensor]" = OrderedDict()
+        self._spill = (
+            _SpillTier(spill_dir, spill_max_bytes)
+            if spill_dir is not None and spill_max_bytes > 0 else None
+        )
+        self._pending: List[Tuple[bytes, torch.Tensor, "torch.cuda.Event"]] = []  # device -> host copies in flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes, device=None) -> Optional[torch.Tensor]:
+        """Cached features for key on device, or None"""
+        with self._lock:
+            self._settle(key)
+            features = self._memory.get(key)
+            if features is not None:
+                self._memory.move_to_end(key)
+            elif self._spill is not None:
+                features = self._spill.pop(key)
+                if features is not None:
+                    if torch.cuda.is_available():
+                        # pinned, so the copy to the device below does not block
+                        features = features.pin_memory()
+                    self._remember(key, features)
+
+            if features is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            log_stats = (self.hits + self.misses) % STATS_LOG_INTERVAL == 0
+
+        if log_stats:
+            print("Vision embedding cache: " + ", ".join(f"{name}={value}" for name, value in self.stats().items()))
+        if features is None:
+            return None
+        return features.to(device, non_blocking=True) if device is not None else features
+
+    def put(self, key: bytes, features: torch.Tensor):
+        """Store features computed for key (copied to host memory)"""
+        size = features.numel() * features.element_size()
+        if size > self.max_bytes:
+            return
+        features = features.detach()
+        if features.is_cuda:
+            # non-blocking copy into pinned memory; stored once it has completed (_settle)
+            host = torch.empty(features.shape, dtype=features.dtype, pin_memory=True)
+            host.copy_(features, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+            with self._lock:
+                self._pending.append((key, host, copied))
+                self._settle()
+            return
+        with self._lock:
+            self._remember(key, features)
+
+    def clear(self):
+        """Drop every entry (call after the weights change)"""
+        with self._lock:
+            self._pending.clear()
+            self._memory.clear()
+            self.total_bytes = 0
+            if self._spill is not None:
+                self._spill.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Lookup counts and memory use, logged every STATS_LOG_INTERVAL lookups"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self.total_bytes,
+            "spill_bytes": self._spill.total_bytes if self._spill is not None else 0,
+        }
+
+    def _settle(self, key: Optional[bytes] = None):
+        """Store the pending copies that have completed; waits for the one of `key` (if pending)"""
+        in_flight = []
+        for pending_key, host, copied in self._pending:
+            if pending_key == key:
+                copied.synchronize()
+            elif not copied.query():
+                in_flight.append((pending_key, host, copied))
+                continue
+            self._remember(pending_key, host)
+        self._pending = in_flight
+
+    def _remember(self, key: bytes, features: torch.Tensor):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self.total_bytes -= old.numel() * old.element_size()
+        self._memory[key] = features
+        self.total_bytes += features.numel() * features.element_size()
+
+        # evict least recently used entries until back under budget
+        while self.total_bytes > self.max_bytes:
+            old_key, old = self._memory.popitem(last=False)
+            self.total_bytes -= old.numel() * old.element_size()
+            if self._spill is not None:
+                self._spill.put(old_key, old)
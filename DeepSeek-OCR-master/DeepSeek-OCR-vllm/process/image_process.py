@@ -1,92 +1,149 @@
 import math
-from typing import List, Tuple
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
 
+import numpy as np
 import torch
-import torchvision.transforms as T
 from PIL import Image, ImageOps
 from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
-
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
-    return best_ratio
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PIXEL_TRANSPORT, EMBED_CACHE_MB, PROMPT, TOKENIZER
+from process.embedding_cache import EMBEDDING_KEY_SIZE, embedding_key, hash_image
+from process.tile_planner import (TILE_PLANNER, TilePlan, count_image_tokens,
+                                  find_closest_aspect_ratio, tile_boxes)
 
 
-def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    aspect_ratio = orig_width / orig_height
+class ImageGeometry(NamedTuple):
+    """Per-request image geometry (resolution preset).
 
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    base_size: side of the padded global view
+    image_size: side of each local tile (and the no-crop threshold)
+    crop_mode: enable dynamic tiling for images larger than image_size
+    min_crops / max_crops: tile count bounds for dynamic tiling
+    """
+    base_size: int = BASE_SIZE
+    image_size: int = IMAGE_SIZE
+    crop_mode: bool = CROP_MODE
+    min_crops: int = MIN_CROPS
+    max_crops: int = MAX_CROPS
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
 
-    return target_aspect_ratio
+DEFAULT_GEOMETRY = ImageGeometry()
 
+# Distinct prompts whose tokenized text segments are kept
+SEGMENT_CACHE_SIZE = 256
 
-def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
+# Pixel formats tokenize_with_images can hand to the model:
+#   float32: normalized [3, H, W] float32 (normalized on the CPU)
+#   uint8:   raw [H, W, 3] uint8, normalized by the model on its device
+PIXEL_TRANSPORTS = ("float32", "uint8")
 
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+# Pixel stride of the sample that rules out non-uniform views before the full check
+UNIFORM_SAMPLE_STRIDE = 16
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    # candidate ratio table is precomputed per (min_num, max_num)
+    return TILE_PLANNER.best_ratio(orig_width, orig_height, min_num, max_num, image_size)
+
+
+def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    orig_width, orig_height = image.size
+    target_aspect_ratio = count_tiles(orig_width, orig_height, min_num, max_num, image_size)
 
-    # print(target_aspect_ratio)
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
     target_height = image_size * target_aspect_ratio[1]
-    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
 
-    # resize the image
+    # resize the image and split it into tiles
     resized_img = image.resize((target_width, target_height))
-    processed_images = []
-    for i in range(blocks):
-        box = (
-            (i % (target_width // image_size)) * image_size,
-            (i // (target_width // image_size)) * image_size,
-            ((i % (target_width // image_size)) + 1) * image_size,
-            ((i // (target_width // image_size)) + 1) * image_size
-        )
-        # split the image
-        split_img = resized_img.crop(box)
-        processed_images.append(split_img)
-    assert len(processed_images) == blocks
+    processed_images = [resized_img.crop(box) for box in tile_boxes(target_aspect_ratio, image_size)]
     if use_thumbnail and len(processed_images) != 1:
         thumbnail_img = image.resize((image_size, image_size))
         processed_images.append(thumbnail_img)
     return processed_images, target_aspect_ratio
 
 
-
+def tile_grid(image, crop_ratio, image_size=640):
+    """Tiles of a crop grid as one uint8 tensor view [rows, cols, 3, image_size, image_size].
+
+    The resized image is converted to an array once; tiles are strided views
+    into it (tile i is grid[i // cols, i % cols]), nothing is copied here.
+    """
+    num_width_tiles, num_height_tiles = crop_ratio
+    size = (image_size * num_width_tiles, image_size * num_height_tiles)
+    # images already at the grid size need no resize
+    resized_img = image.resize(size) if image.size != size else image
+    if resized_img.mode != 'RGB':
+        resized_img = resized_img.convert('RGB')
+    pixels = torch.from_numpy(np.array(resized_img))
+    return pixels.view(num_height_tiles, image_size, num_width_tiles, image_size, 3).permute(0, 2, 4, 1, 3)
+
+
+def dynamic_preprocess_grid(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640):
+    """Same tiles as dynamic_preprocess, as a tile_grid view"""
+    crop_ratio = count_tiles(image.size[0], image.size[1], min_num, max_num, image_size)
+    return tile_grid(image, crop_ratio, image_size), crop_ratio
+
+
+def uniform_colors(views: torch.Tensor) -> torch.Tensor:
+    """Colour code of each uint8 view [n, 3, H, W] (any strides): 0xRRGGBB if the view is one colour, else -1.
+
+    A strided sample rules out most views; only the remaining candidates get
+    the full min/max pass.
+    """
+    codes = torch.full((views.shape[0],), -1, dtype=torch.int32)
+    sample = views[..., ::UNIFORM_SAMPLE_STRIDE, ::UNIFORM_SAMPLE_STRIDE]
+    candidates = (sample.amin(dim=(-2, -1)) == sample.amax(dim=(-2, -1))).all(dim=-1)
+    for idx in candidates.nonzero().flatten().tolist():
+        low = views[idx].amin(dim=(-2, -1))
+        if torch.equal(low, views[idx].amax(dim=(-2, -1))):
+            red, green, blue = low.tolist()
+            codes[idx] = (red << 16) | (green << 8) | blue
+    return codes
+
+
+def get_crop_ratio(width, height, geometry: ImageGeometry = DEFAULT_GEOMETRY):
+    """Tile grid (num_width_tiles, num_height_tiles) used for an image of this size"""
+    return TILE_PLANNER.plan(width, height, geometry).crop_ratio
+
+
+def native_size(width, height, geometry: ImageGeometry = DEFAULT_GEOMETRY) -> Tuple[int, int]:
+    """Size to produce an image at (e.g. rasterize a PDF page) so it carries the detail of the processor's largest view.
+
+    width, height is the size the image would otherwise have; it picks the
+    tile plan. The image keeps its aspect ratio (so it stays true to the
+    page, e.g. for layout drawings); only the processor's own resize changes
+    it. Views the processor stretches the image to (the tile grid with crops,
+    the image_size square for small no-crop presets) are covered, so no side
+    is upscaled; otherwise the image is contained in the padded base_size
+    global view. Falls back to (width, height) if the new size would change
+    the tile plan.
+    """
+    width, height = max(1, round(width)), max(1, round(height))
+    plan = TILE_PLANNER.plan(width, height, geometry)
+    if plan.has_crops:
+        box, cover = plan.resized_size, True
+    elif geometry.image_size <= 640 and not geometry.crop_mode:
+        box, cover = (geometry.image_size, geometry.image_size), True
+    else:
+        box, cover = (geometry.base_size, geometry.base_size), False
+    # same rounding as ImageOps.contain (ImageOps.cover when covering)
+    if (width / height > box[0] / box[1]) != cover:
+        size = (box[0], max(1, round(height / width * box[0])))
+    else:
+        size = (max(1, round(width / height * box[1])), box[1])
+
+    if TILE_PLANNER.plan(size[0], size[1], geometry).crop_ratio != plan.crop_ratio:
+        return width, height
+    return size
 
 
 class ImageTransform:
+    """ToTensor + Normalize, computed on whole uint8 batches at once.
+
+    Output is bit-identical to torchvision's ToTensor() followed by
+    Normalize(mean, std): x / 255, then (x - mean) / std, in float32.
+    """
 
     def __init__(self,
                  mean: Tuple[float, float, float] = (0.5, 0.5, 0.5),
@@ -96,17 +153,46 @@ class ImageTransform:
         self.std = std
         self.normalize = normalize
 
-        transform_pipelines = [T.ToTensor()]
-
-        if normalize:
-            transform_pipelines.append(T.Normalize(mean, std))
-
-        self.transform = T.Compose(transform_pipelines)
+        self._mean = torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self._std = torch.tensor(std, dtype=torch.float32).view(-1, 1, 1)
 
     def __call__(self, pil_img: Image.Image):
-        x = self.transform(pil_img)
+        pixels = np.array(pil_img)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        return self.batch(torch.from_numpy(pixels).permute(2, 0, 1))
+
+    def batch(self, images: torch.Tensor) -> torch.Tensor:
+        """uint8 [..., C, H, W] (any strides, e.g. a tile grid view) -> contiguous normalized float32"""
+        # the dtype conversion is the only copy; the rest runs in place
+        x = images.to(torch.float32, memory_format=torch.contiguous_format)
+        x.div_(255)
+        if self.normalize:
+            x.sub_(self._mean.to(x.device)).div_(self._std.to(x.device))
         return x
 
+    def batch_hwc(self, images: torch.Tensor) -> torch.Tensor:
+        """uint8 [..., H, W, C] (the uint8 pixel transport) -> contiguous normalized float32 [..., C, H, W]"""
+        return self.batch(images.movedim(-1, -3))
+
+    def pad(self, image: Image.Image, size: Tuple[int, int], color: Tuple[int, ...]) -> torch.Tensor:
+        """Same as self(ImageOps.pad(image, size, color=color)), without building the padded image.
+
+        Only the resized content is normalized; the border is one normalized
+        color broadcast into place.
+        """
+        resized = ImageOps.contain(image, size)
+        if resized.size == size:
+            return self(resized)
+
+        fill = torch.tensor(color, dtype=torch.uint8).view(-1, 1, 1)
+        out = self.batch(fill).expand(-1, size[1], size[0]).contiguous()
+        # paste offsets as in ImageOps.pad (centering=(0.5, 0.5))
+        x = round((size[0] - resized.width) * 0.5) if resized.width != size[0] else 0
+        y = round((size[1] - resized.height) * 0.5) if resized.width == size[0] else 0
+        out[:, y:y + resized.height, x:x + resized.width] = self(resized)
+        return out
+
 
 class DeepseekOCRProcessor(ProcessorMixin):
     tokenizer_class = ("LlamaTokenizer", "LlamaTokenizerFast")
@@ -127,6 +213,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
         sft_format: str = "deepseek",
         mask_prompt: bool = True,
         ignore_id: int = -100,
+        pixel_transport: str = PIXEL_TRANSPORT,
         **kwargs,
     ):
 
@@ -143,6 +230,10 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize)
 
+        if pixel_transport not in PIXEL_TRANSPORTS:
+            raise ValueError(f"pixel_transport must be one of {PIXEL_TRANSPORTS}, got {pixel_transport!r}")
+        self.pixel_transport = pixel_transport
+
 
         self.tokenizer = tokenizer
         # self.tokenizer = add_special_token(tokenizer)
@@ -181,6 +272,10 @@ class DeepseekOCRProcessor(ProcessorMixin):
         self.mask_prompt = mask_prompt
         self.ignore_id = ignore_id
 
+        # prompt text segments (per prompt) and <image> token runs (per tile plan)
+        self._segment_cache = OrderedDict()
+        self._image_token_cache = {}
+
         super().__init__(
             tokenizer,
             **kwargs,
@@ -259,9 +354,12 @@ class DeepseekOCRProcessor(ProcessorMixin):
             outputs (BaseProcessorOutput): the output of the processor,
                 - input_ids (torch.LongTensor): [N + image tokens]
                 - target_ids (torch.LongTensor): [N + image tokens]
-                - pixel_values (torch.FloatTensor): [n_patches, 3, H, W]
+                - pixel_values (torch.FloatTensor): [n_patches, 3, H, W] (uint8 [n_patches, H, W, 3] with the uint8 pixel transport)
                 - image_id (int): the id of the image token
                 - num_image_tokens (List[int]): the number of image tokens
+                - images_key (torch.ByteTensor): [n_images, 16] vision embedding cache keys (all zero = uncached)
+                - images_color (torch.IntTensor): [n_images] uniform_colors code of each global view (-1 = not one colour)
+                - images_crop_color (torch.IntTensor): [1, n_patches] uniform_colors code of each tile
         """
 
         assert (prompt is not None and images is not None
@@ -269,7 +367,8 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         sft_format = prompt
 
-        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _ = images[0]
+        (input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _, _,
+         images_key, images_color, images_crop_color) = images[0]
 
 
         return {
@@ -279,6 +378,9 @@ class DeepseekOCRProcessor(ProcessorMixin):
             "images_seq_mask": images_seq_mask,
             "images_spatial_crop": images_spatial_crop,
             "num_image_tokens": num_image_tokens,
+            "images_key": images_key,
+            "images_color": images_color,
+            "images_crop_color": images_crop_color,
         }
 
 
@@ -327,6 +429,96 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         return prepare
 
+    def _text_segments(self, conversation: str) -> List[torch.Tensor]:
+        """Token ids of the text around each <image> tag, cached per prompt"""
+        segments = self._segment_cache.get(conversation)
+        if segments is not None:
+            self._segment_cache.move_to_end(conversation)
+            return segments
+
+        segments = [torch.tensor(self.encode(text_sep, bos=False, eos=False), dtype=torch.long)
+                    for text_sep in conversation.split(self.image_token)]
+        self._segment_cache[conversation] = segments
+        if len(self._segment_cache) > SEGMENT_CACHE_SIZE:
+            self._segment_cache.popitem(last=False)
+        return segments
+
+    def _image_tokens(self, num_image_tokens: int) -> torch.Tensor:
+        """Run of <image> token ids for one image, cached per token count (i.e. per tile plan)"""
+        block = self._image_token_cache.get(num_image_tokens)
+        if block is None:
+            block = torch.full((num_image_tokens,), self.image_token_id, dtype=torch.long)
+            self._image_token_cache[num_image_tokens] = block
+        return block
+
+    def _process_image(self, image: Image.Image, geometry: ImageGeometry):
+        """
+        Pixel inputs of one image, in the pixel transport format:
+        (tile plan, global view, tiles or None, global view colour, tile colours or None).
+
+        Colours are uniform_colors codes; the encoder reuses one embedding per
+        colour and size for single-colour views.
+        """
+        plan = TILE_PLANNER.plan(image.size[0], image.size[1], geometry)
+        uint8 = self.pixel_transport == "uint8"
+
+        """process the local views"""
+        crops, crop_colors = None, None
+        if plan.has_crops:
+            # all tiles handled in one pass, row-major like dynamic_preprocess
+            crop_grid = tile_grid(image, plan.crop_ratio, geometry.image_size)
+            crop_colors = uniform_colors(crop_grid.flatten(0, 1))
+            if uint8:
+                crops = crop_grid.flatten(0, 1).permute(0, 2, 3, 1).contiguous()
+            else:
+                crops = self.image_transform.batch(crop_grid).flatten(0, 1)
+
+        """process the global view"""
+        if geometry.image_size <= 640 and not geometry.crop_mode and image.size != (geometry.image_size, geometry.image_size):
+            image = image.resize((geometry.image_size, geometry.image_size))
+
+        size = (geometry.base_size, geometry.base_size)
+        color = tuple(int(x * 255) for x in self.image_transform.mean)
+        if uint8:
+            global_view = torch.from_numpy(np.array(ImageOps.pad(image, size, color=color)))
+            global_color = int(uniform_colors(global_view.permute(2, 0, 1)[None])[0])
+        else:
+            global_view = self.image_transform.pad(image, size, color=color)
+            global_color = self._normalized_color(image, global_view)
+        return plan, global_view, crops, global_color, crop_colors
+
+    def _normalized_color(self, image: Image.Image, view: torch.Tensor) -> int:
+        """uniform_colors code of a normalized float32 view built from image (-1 unless it is one colour)"""
+        extrema = (image if image.mode == 'RGB' else image.convert('RGB')).getextrema()
+        if any(low != high for low, high in extrema):
+            return -1
+        # the resized / padded view must hold exactly that colour too
+        rgb = torch.tensor([low for low, _ in extrema], dtype=torch.uint8)
+        if not torch.equal(view, self.image_transform.batch(rgb.view(3, 1, 1)).expand_as(view)):
+            return -1
+        red, green, blue = rgb.tolist()
+        return (red << 16) | (green << 8) | blue
+
+    def _assemble(self, conversation: str, plans: List[TilePlan], bos: bool = True):
+        """input_ids and images_seq_mask for a prompt, from cached text segments and image-token runs"""
+        segments = self._text_segments(conversation)
+        assert len(segments) == len(plans) + 1
+
+        pieces = [torch.tensor([self.bos_id], dtype=torch.long)] if bos else []
+        mask_pieces = [torch.zeros(1, dtype=torch.bool)] if bos else []
+        for segment, plan in zip(segments, plans):
+            image_tokens = self._image_tokens(plan.num_image_tokens)
+            pieces += [segment, image_tokens]
+            mask_pieces += [torch.zeros(len(segment), dtype=torch.bool),
+                            torch.ones(len(image_tokens), dtype=torch.bool)]
+        pieces.append(segments[-1])
+        mask_pieces.append(torch.zeros(len(segments[-1]), dtype=torch.bool))
+
+        input_ids = torch.cat(pieces)
+        images_seq_mask = torch.cat(mask_pieces)
+        input_ids[input_ids < 0] = self.pad_id
+        return input_ids, images_seq_mask
+
     def tokenize_with_images(
         self,
         # conversation: str,
@@ -335,170 +527,96 @@ class DeepseekOCRProcessor(ProcessorMixin):
         bos: bool = True,
         eos: bool = True,
         cropping: bool = True,
+        geometry: Optional[ImageGeometry] = None,
+        image_digests: Optional[List[str]] = None,
     ):
-        """Tokenize text with <image> tags."""
+        """Tokenize text with <image> tags.
+
+        `geometry` selects the per-request resolution; when omitted the
+        processor defaults are used with `cropping` as crop mode.
+        `image_digests` are pixel digests the caller already computed (see
+        process.embedding_cache.hash_image); they key the model's vision
+        embedding cache.
+        """
 
-        # print(conversation)
         # Use the provided prompt, or fall back to the default PROMPT if not provided
         conversation = prompt if prompt is not None else PROMPT
+        if geometry is None:
+            geometry = ImageGeometry(base_size=self.base_size, image_size=self.image_size, crop_mode=cropping)
         assert conversation.count(self.image_token) == len(images)
-        text_splits = conversation.split(self.image_token)
-        images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
-        image_shapes = []
-        num_image_tokens = []
-        tokenized_str = []
-        # print('image: ', len(images))
-        for text_sep, image in zip(text_splits, images):
-            """encode text_sep"""
-            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
-            tokenized_str += tokenized_sep
-            images_seq_mask += [False] * len(tokenized_sep)
-
-            """select best resolution for anyres"""
-            # if cropping:
-            #     best_width, best_height = self.select_best_resolution(image.size)
-            # else:
-            #     best_width, best_height = self.image_size, self.image_size
-
-            image_shapes.append(image.size)
-
-            if image.size[0] <= 640 and image.size[1] <= 640:
-                crop_ratio = [1, 1]
+        # inference mode: the trailing eos token is always removed again
+        assert eos, "tokenize_with_images expects eos=True"
+
+        plans, images_list, images_crop_list = [], [], []
+        global_colors, crop_colors_list = [], []
+        for image in images:
+            plan, global_view, crops, global_color, crop_colors = self._process_image(image, geometry)
+            plans.append(plan)
+            images_list.append(global_view)
+            global_colors.append(global_color)
+            if crops is not None:
+                images_crop_list.append(crops)
+                crop_colors_list.append(crop_colors)
+
+        input_ids, images_seq_mask = self._assemble(conversation, plans, bos=bos)
+
+        image_shapes = [image.size for image in images]
+        num_image_tokens = [plan.num_image_tokens for plan in plans]
+
+        if self.pixel_transport == "uint8":
+            # raw HWC pixels; images without crops carry an empty tile tensor
+            if len(images_list) == 0:
+                pixel_values = torch.zeros((1, geometry.base_size, geometry.base_size, 3), dtype=torch.uint8)
             else:
-                if cropping:
-                    # print('image-size: ', image.size)
-                    # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
-                    # print('image ', image.size)
-                    # print('open_size:', image.size)
-                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
-                    # print('crop_ratio: ', crop_ratio)
-                else:
-                    # best_width, best_height = self.image_size, self.image_size
-                    crop_ratio = [1, 1]
-            # print(image.size, (best_width, best_height)) # check the select_best_resolutions func
-
-            # print(crop_ratio)
-            """process the global view"""
-
-            # if cropping
-            if self.image_size <= 640 and not cropping:
-                # print('directly resize')
-                image = image.resize((self.image_size, self.image_size))
-
-            global_view = ImageOps.pad(image, (self.base_size, self.base_size),
-                                    color=tuple(int(x * 255) for x in self.image_transform.mean))
-            images_list.append(self.image_transform(global_view))
-
-            """record height / width crop num"""
-            # width_crop_num, height_crop_num = best_width // self.image_size, best_height // self.image_size
-            num_width_tiles, num_height_tiles = crop_ratio
-            images_spatial_crop.append([num_width_tiles, num_height_tiles])
-
-
-
-
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                """process the local views"""
-                # local_view = ImageOps.pad(image, (best_width, best_height),
-                #                         color=tuple(int(x * 255) for x in self.image_transform.mean))
-                # for i in range(0, best_height, self.image_size):
-                #     for j in range(0, best_width, self.image_size):
-                #         images_crop_list.append(
-                #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
-                for i in range(len(images_crop_raw)):
-                    images_crop_list.append(self.image_transform(images_crop_raw[i]))
-
-            # """process the global view"""
-            # global_view = ImageOps.pad(image, (self.image_size, self.image_size),
-            #                            color=tuple(int(x * 255) for x in self.image_transform.mean))
-            # images_list.append(self.image_transform(global_view))
-
-            # """process the local views"""
-            # local_view = ImageOps.pad(image, (best_width, best_height),
-            #                           color=tuple(int(x * 255) for x in self.image_transform.mean))
-            # for i in range(0, best_height, self.image_size):
-            #     for j in range(0, best_width, self.image_size):
-            #         images_list.append(
-            #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
-
-            # """add image tokens"""
-            """add image tokens"""
-            num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
-            num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
-
-
-            tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
-            tokenized_image += [self.image_token_id]
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                tokenized_image += ([self.image_token_id] * (num_queries * num_width_tiles) + [self.image_token_id]) * (
-                            num_queries * num_height_tiles)
-            tokenized_str += tokenized_image
-            images_seq_mask += [True] * len(tokenized_image)
-            num_image_tokens.append(len(tokenized_image))
-
-        """process the last text split"""
-        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
-        tokenized_str += tokenized_sep
-        images_seq_mask += [False] * len(tokenized_sep)
-
-        """add the bos and eos tokens"""
-        if bos:
-            tokenized_str = [self.bos_id] + tokenized_str
-            images_seq_mask = [False] + images_seq_mask
-        if eos:
-            tokenized_str = tokenized_str + [self.eos_id]
-            images_seq_mask = images_seq_mask + [False]
-
-        assert len(tokenized_str) == len(
-            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
-        
-
-
-        masked_tokenized_str = []
-        for token_index in tokenized_str:
-            if token_index != self.image_token_id:
-                masked_tokenized_str.append(token_index)
+                pixel_values = torch.stack(images_list, dim=0)
+            if images_crop_list:
+                images_crop = torch.cat(images_crop_list, dim=0).unsqueeze(0)
             else:
-                masked_tokenized_str.append(self.ignore_id)
-
-        assert len(tokenized_str) == len(images_seq_mask) == len(masked_tokenized_str), \
-            (f"tokenized_str's length {len(tokenized_str)}, input_ids' length {len(masked_tokenized_str)}, "
-             f"imags_seq_mask's length {len(images_seq_mask)}, are not equal")
-
-        input_ids = torch.LongTensor(tokenized_str)
-        target_ids = torch.LongTensor(masked_tokenized_str)
-        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
-
-        # set input_ids < 0 | input_ids == self.image_token_id as ignore_id
-        target_ids[(input_ids < 0) |
-                   (input_ids == self.image_token_id)] = self.ignore_id
-        input_ids[input_ids < 0] = self.pad_id
-
-        inference_mode = True
-
-        if inference_mode:
-            # Remove the ending eos token
-            assert input_ids[-1] == self.eos_id
-            input_ids = input_ids[:-1]
-            target_ids = target_ids[:-1]
-            images_seq_mask = images_seq_mask[:-1]
-
-        if len(images_list) == 0:
-            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
-            images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
-            images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+                images_crop = torch.empty((1, 0, geometry.image_size, geometry.image_size, 3), dtype=torch.uint8)
+        elif len(images_list) == 0:
+            pixel_values = torch.zeros((1, 3, geometry.base_size, geometry.base_size))
+            images_crop = torch.zeros((1, 3, geometry.image_size, geometry.image_size)).unsqueeze(0)
         else:
             pixel_values = torch.stack(images_list, dim=0)
-            images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
             if images_crop_list:
-                images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
+                images_crop = torch.cat(images_crop_list, dim=0).unsqueeze(0)
             else:
-                images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+                images_crop = torch.zeros((1, 3, geometry.image_size, geometry.image_size)).unsqueeze(0)
+
+        if len(images_list) == 0:
+            images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
+        else:
+            images_spatial_crop = torch.tensor([list(plan.crop_ratio) for plan in plans], dtype=torch.long)
 
         input_ids = input_ids.unsqueeze(0)
 
-        
-        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
+        images_key = self._embedding_keys(images, geometry, image_digests)
+
+        # single-colour views: per global view [n_images], per tile [1, n_tiles] like images_crop
+        images_color = torch.tensor(global_colors or [-1], dtype=torch.int32)
+        if crop_colors_list:
+            images_crop_color = torch.cat(crop_colors_list).unsqueeze(0)
+        else:
+            images_crop_color = torch.empty((1, 0), dtype=torch.int32)
+
+        # geometry travels with the item so vLLM's prompt replacement counts the same tokens
+        geometries = [geometry] * len(image_shapes)
+        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes, geometries,
+                 images_key, images_color, images_crop_color]]
+
+    def _embedding_keys(self, images: List[Image.Image], geometry: ImageGeometry,
+                        image_digests: Optional[List[str]] = None) -> torch.Tensor:
+        """[n_images, EMBEDDING_KEY_SIZE] uint8 vision embedding cache keys; all zero when the cache is off"""
+        keys = torch.zeros((max(1, len(images)), EMBEDDING_KEY_SIZE), dtype=torch.uint8)
+        if EMBED_CACHE_MB <= 0 or not images:
+            return keys
+
+        if image_digests is None:
+            image_digests = [hash_image(image) for image in images]
+        for idx, digest in enumerate(image_digests):
+            key = embedding_key(digest, geometry, self.pixel_transport)
+            keys[idx] = torch.frombuffer(bytearray(key), dtype=torch.uint8)
+        return keys
 
 
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
@@ -1,7 +1,8 @@
 import torch
 from transformers import LogitsProcessor
 from transformers.generation.logits_process import _calc_banned_ngram_tokens
-from typing import List, Set
+from collections import deque
+from typing import Any, Dict, List
 
 
 class NoRepeatNGramLogitsProcessor(LogitsProcessor):
@@ -37,4 +38,154 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
             for token in banned_tokens:
                 scores[token] = -float("inf")
         
-        return scores
\ No newline at end of file
+        return scores
+
+
+# SamplingParams.extra_args key carrying a request's n-gram ban settings
+NO_REPEAT_NGRAM_ARG = "no_repeat_ngram"
+
+
+def no_repeat_ngram_args(ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None) -> Dict[str, Any]:
+    """
+    SamplingParams.extra_args asking for NoRepeatNGramLogitsProcessor's bans.
+
+    DeepseekOCRForCausalLM.compute_logits applies them to the batched logits
+    (NoRepeatNGramBans). Unlike an entry in
+    SamplingParams.logits_processors, this keeps vLLM's per-sequence logits
+    processor loop from running at all.
+    """
+    NoRepeatNGramLogitsProcessor(ngram_size, window_size)  # validates the settings
+    whitelist = tuple(sorted(whitelist_token_ids or ()))
+    return {NO_REPEAT_NGRAM_ARG: (ngram_size, window_size, whitelist)}
+
+
+# Sequences absent from this many steps (finished or aborted) lose their index
+STALE_AFTER_STEPS = 64
+
+
+class NoRepeatNGramBans:
+    """
+    Applies the bans requested with no_repeat_ngram_args to batched logits.
+
+    Every running sequence keeps a rolling prefix -> next-token index over the
+    n-grams in its window (_NGramIndex): a decode step only indexes the n-grams
+    ending at the new tokens and expires those that slid out of the window,
+    instead of rescanning the window. The bans of all rows are then written
+    with one indexed assignment. Banned tokens are identical to
+    NoRepeatNGramLogitsProcessor.
+
+    DeepseekOCRForCausalLM.compute_logits calls its instance every step.
+    """
+
+    def __init__(self):
+        self._indexes: Dict[int, "_NGramIndex"] = {}
+        self._step = 0
+
+    def __call__(self, logits: torch.Tensor, sampling_metadata) -> torch.Tensor:
+        """
+        Ban repeated n-grams in place for every sequence that requested it.
+
+        Args:
+            logits: Batched logits [num_rows, vocab_size]
+            sampling_metadata: vLLM SamplingMetadata for this step
+
+        Returns:
+            The same logits tensor
+        """
+        self._step += 1
+        rows, tokens = [], []
+        for seq_group in sampling_metadata.seq_groups:
+            settings = (seq_group.sampling_params.extra_args or {}).get(NO_REPEAT_NGRAM_ARG)
+            if settings is None:
+                continue
+            for seq_id, row_idx in zip(seq_group.seq_ids, seq_group.sample_indices):
+                index = self._indexes.get(seq_id)
+                if index is None or index.settings != settings:
+                    index = self._indexes[seq_id] = _NGramIndex(*settings)
+                index.last_step = self._step
+                # the array itself: output_token_ids would copy the whole output every step
+                banned = index.banned_tokens(seq_group.seq_data[seq_id].output_token_ids_array)
+                rows.extend([row_idx] * len(banned))
+                tokens.extend(banned)
+
+        if rows:
+            rows = torch.tensor(rows, dtype=torch.long, device=logits.device)
+            tokens = torch.tensor(tokens, dtype=torch.long, device=logits.device)
+            logits[rows, tokens] = -float("inf")
+        self._evict_stale()
+        return logits
+
+    def _evict_stale(self):
+        if self._step % STALE_AFTER_STEPS:
+            return
+        self._indexes = {seq_id: index for seq_id, index in self._indexes.items()
+                         if self._step - index.last_step < STALE_AFTER_STEPS}
+
+
+class _NGramIndex:
+    """Rolling prefix -> next-token index over the n-grams in one sequence's window"""
+
+    def __init__(self, ngram_size: int, window_size: int, whitelist_token_ids):
+        self.settings = (ngram_size, window_size, whitelist_token_ids)
+        self.ngram_size = ngram_size
+        self.window_size = window_size
+        self.whitelist_token_ids = set(whitelist_token_ids)
+        self.last_step = 0
+        self._reset()
+
+    def _reset(self):
+        self._seen = 0                # number of tokens already indexed
+        self._tail = ()               # tokens in the window at self._seen, for continuity checks
+        self._ngrams = deque()        # (start, prefix, next_token) in window order
+        self._index = {}              # prefix -> {next_token: count}
+
+    def _is_continuation(self, input_ids, length: int) -> bool:
+        if length < self._seen:
+            return False
+        start = self._seen - len(self._tail)
+        return self._seen == 0 or input_ids[start:self._seen] == self._tail
+
+    def _advance(self, input_ids, length: int):
+        """Index n-grams ending at the new tokens and expire those outside the window"""
+        n = self.ngram_size
+        # n-grams starting before length - window_size are never looked at again
+        first_end = max(self._seen + 1, length - self.window_size + n, n)
+        for end in range(first_end, length + 1):
+            start = end - n
+            prefix = tuple(input_ids[start:end - 1])
+            token = input_ids[end - 1]
+            self._ngrams.append((start, prefix, token))
+            next_tokens = self._index.setdefault(prefix, {})
+            next_tokens[token] = next_tokens.get(token, 0) + 1
+
+        search_start = length - self.window_size
+        while self._ngrams and self._ngrams[0][0] < search_start:
+            _, prefix, token = self._ngrams.popleft()
+            next_tokens = self._index[prefix]
+            if next_tokens[token] > 1:
+                next_tokens[token] -= 1
+            else:
+                del next_tokens[token]
+                if not next_tokens:
+                    del self._index[prefix]
+
+        self._seen = length
+        self._tail = input_ids[max(0, length - max(n, self.window_size)):length]
+
+    def banned_tokens(self, input_ids) -> List[int]:
+        """Tokens completing an n-gram already in the window, for output `input_ids`"""
+        # ngram_size == 1 never matches a prefix in the reference implementation
+        if self.ngram_size == 1:
+            return []
+
+        length = len(input_ids)
+        if not self._is_continuation(input_ids, length):
+            self._reset()
+        self._advance(input_ids, length)
+
+        if length < self.ngram_size:
+            return []
+        next_tokens = self._index.get(tuple(input_ids[length - self.ngram_size + 1:]))
+        if not next_tokens:
+            return []
+        return [token for token in next_tokens if token not in self.whitelist_token_ids]
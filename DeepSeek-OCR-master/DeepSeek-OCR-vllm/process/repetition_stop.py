@@ -0,0 +1,135 @@
+from typing import Any, Dict, List, Optional, Set
+
+import torch
+
+
+# Sequences checked together (bounds the [rows, periods, window] comparison tensor)
+CHECK_ROWS_PER_PASS = 16
+
+
+# SamplingParams.extra_args key carrying a request's loop detection settings
+REPETITION_STOP_ARG = "repetition_stop"
+
+
+def repetition_stop_args(
+    stop_token_id: int,
+    window_size: int = 1536,
+    max_period: int = 300,
+    min_repeats: int = 5,
+    min_span: int = 512,
+    check_interval: int = 32,
+    whitelist_token_ids: Optional[Set[int]] = None,
+) -> Dict[str, Any]:
+    """
+    SamplingParams.extra_args asking to stop the output once it degenerates into a loop.
+
+    Every `check_interval` generated tokens the last `window_size` tokens are
+    checked for periodicity: the output is looping when, for some period
+    p <= max_period, the trailing tokens repeat with period p over at least
+    max(min_span, min_repeats * p) tokens. Loops whose repeating unit only
+    consists of whitelisted tokens (e.g. empty table cells) do not count.
+
+    A looping sequence is forced to emit `stop_token_id`, which must be in
+    SamplingParams.stop_token_ids, so it finishes with that token as its
+    stop_reason (see is_repetition_stop) instead of decoding up to max_tokens.
+
+    DeepseekOCRForCausalLM.compute_logits applies it to the batched logits
+    (apply_repetition_stop); being no logits processor, it keeps vLLM's
+    per-sequence logits processor loop from running.
+    """
+    if max_period <= 0 or window_size < 2 * max_period:
+        raise ValueError(f"`window_size` ({window_size}) must be at least twice `max_period` ({max_period})")
+    if min_repeats < 2:
+        raise ValueError(f"`min_repeats` has to be at least 2, but is {min_repeats}")
+    if min_span >= window_size:
+        raise ValueError(f"`min_span` ({min_span}) must be smaller than `window_size` ({window_size})")
+    if check_interval <= 0:
+        raise ValueError(f"`check_interval` has to be a strictly positive integer, but is {check_interval}")
+    whitelist = tuple(sorted(whitelist_token_ids or ()))
+    return {REPETITION_STOP_ARG: (stop_token_id, window_size, max_period, min_repeats,
+                                  min_span, check_interval, whitelist)}
+
+
+def apply_repetition_stop(logits: torch.Tensor, sampling_metadata) -> torch.Tensor:
+    """
+    Force the stop token for every looping sequence that requested detection.
+
+    Args:
+        logits: Batched logits [num_rows, vocab_size]
+        sampling_metadata: vLLM SamplingMetadata for this step
+
+    Returns:
+        The same logits tensor
+    """
+    # Only sequences at a check point; grouped by settings
+    groups = {}
+    for seq_group in sampling_metadata.seq_groups:
+        settings = (seq_group.sampling_params.extra_args or {}).get(REPETITION_STOP_ARG)
+        if settings is None:
+            continue
+        stop_token_id, window_size, max_period, min_repeats, min_span, check_interval, whitelist = settings
+        for seq_id, row_idx in zip(seq_group.seq_ids, seq_group.sample_indices):
+            output_ids = seq_group.seq_data[seq_id].output_token_ids_array
+            if len(output_ids) < min_span or len(output_ids) % check_interval:
+                continue
+            key = (stop_token_id, window_size, max_period, min_repeats, min_span, whitelist)
+            row_indices, tails = groups.setdefault(key, ([], []))
+            row_indices.append(row_idx)
+            tails.append(output_ids[-window_size:])
+
+    for (stop_token_id, window_size, max_period, min_repeats, min_span, whitelist), (row_indices, tails) in groups.items():
+        for start in range(0, len(row_indices), CHECK_ROWS_PER_PASS):
+            looping = _find_loops(tails[start:start + CHECK_ROWS_PER_PASS], window_size, max_period,
+                                  min_repeats, min_span, set(whitelist), logits.device)
+            rows = [row for row, loop in zip(row_indices[start:start + CHECK_ROWS_PER_PASS], looping) if loop]
+            if rows:
+                rows = torch.tensor(rows, dtype=torch.long, device=logits.device)
+                logits[rows] = -float("inf")
+                logits[rows, stop_token_id] = 0.0
+    return logits
+
+
+def _find_loops(
+    tails: List[List[int]],
+    window_size: int,
+    max_period: int,
+    min_repeats: int,
+    min_span: int,
+    whitelist: Set[int],
+    device,
+) -> List[bool]:
+    """Whether each token tail ends in a loop (see repetition_stop_args)"""
+    # Left-pad with distinct negative ids: padding never matches anything
+    padded = [list(range(-window_size, -len(tail))) + list(tail) for tail in tails]
+    tokens = torch.tensor(padded, dtype=torch.long, device=device)            # [B, W]
+
+    num_checked = window_size - max_period
+    positions = torch.arange(window_size - 1, max_period - 1, -1, device=device)  # [J], last token first
+    periods = torch.arange(1, max_period + 1, device=device)                       # [P]
+    current = tokens[:, positions]                                                 # [B, J]
+    shifted = tokens[:, positions.unsqueeze(0) - periods.unsqueeze(1)]             # [B, P, J]
+    matches = shifted == current.unsqueeze(1)
+
+    # trailing tokens equal to the token one period earlier
+    run = torch.where(matches.all(dim=-1),
+                      torch.full_like(periods, num_checked),
+                      (~matches).int().argmax(dim=-1))                             # [B, P]
+    looping = run + periods >= torch.clamp(periods * min_repeats, min=min_span)
+    if whitelist:
+        # the repeating unit (last p tokens) must hold a token outside the whitelist
+        allowed = torch.tensor(sorted(whitelist), dtype=torch.long, device=device)
+        content = ~torch.isin(tokens, allowed)
+        looping &= content.flip(1).cumsum(dim=1)[:, :max_period] > 0
+    return looping.any(dim=-1).tolist()
+
+
+def is_repetition_stop(completion_output, stop_token_id: int) -> bool:
+    """Whether a vLLM CompletionOutput was stopped by the loop detection (repetition_stop_args)"""
+    return completion_output.stop_reason == stop_token_id
+
+
+def repetition_stop_token_id(tokenizer) -> int:
+    """Token forced to stop looping sequences: the pad token, which the model never generates"""
+    if tokenizer.pad_token_id is not None:
+        return tokenizer.pad_token_id
+    return tokenizer.convert_tokens_to_ids("<｜▁pad▁｜>")
@@ -0,0 +1,112 @@
+"""Crop-grid planning shared by the processor and vLLM token counting.
+
+Kept free of config / tokenizer imports so it is cheap to import anywhere.
+"""
+import math
+from functools import lru_cache
+from typing import NamedTuple, Tuple
+
+
+class TilePlan(NamedTuple):
+    """Everything derived from (image size, geometry)"""
+    crop_ratio: Tuple[int, int]                     # (num_width_tiles, num_height_tiles)
+    boxes: Tuple[Tuple[int, int, int, int], ...]    # tile boxes in the resized image, row-major
+    num_image_tokens: int
+
+    @property
+    def has_crops(self) -> bool:
+        return self.crop_ratio[0] > 1 or self.crop_ratio[1] > 1
+
+    @property
+    def resized_size(self) -> Tuple[int, int]:
+        """(width, height) the image is resized to before tiling"""
+        if not self.boxes:
+            return (0, 0)
+        return (self.boxes[-1][2], self.boxes[-1][3])
+
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
+    return best_ratio
+
+
+@lru_cache(maxsize=None)
+def candidate_ratios(min_num: int, max_num: int) -> Tuple[Tuple[int, int], ...]:
+    """Tile grids with min_num <= tiles <= max_num, ordered by tile count"""
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
+
+
+def tile_boxes(crop_ratio, image_size) -> Tuple[Tuple[int, int, int, int], ...]:
+    """Crop boxes of each tile in the resized image (row-major, as in dynamic_preprocess)"""
+    num_width_tiles, num_height_tiles = crop_ratio
+    return tuple(
+        (col * image_size, row * image_size, (col + 1) * image_size, (row + 1) * image_size)
+        for row in range(num_height_tiles)
+        for col in range(num_width_tiles)
+    )
+
+
+def count_image_tokens(crop_ratio, geometry, patch_size=16, downsample_ratio=4):
+    """Number of <image> tokens for a tile grid: global view rows (+newline), local grid rows (+newline), separator"""
+    num_width_tiles, num_height_tiles = crop_ratio
+    num_queries = math.ceil((geometry.image_size // patch_size) / downsample_ratio)
+    num_queries_base = math.ceil((geometry.base_size // patch_size) / downsample_ratio)
+
+    num_tokens = (num_queries_base + 1) * num_queries_base + 1
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        num_tokens += (num_queries * num_width_tiles + 1) * (num_queries * num_height_tiles)
+    return num_tokens
+
+
+class TilePlanner:
+    """
+    Memoized crop-grid planner.
+
+    `plan(width, height, geometry)` returns the crop ratio, tile boxes and
+    vision-token count for an image in one cached answer. `geometry` is any
+    hashable object with base_size, image_size, crop_mode, min_crops and
+    max_crops (e.g. process.image_process.ImageGeometry).
+    """
+
+    def __init__(self, patch_size: int = 16, downsample_ratio: int = 4, cache_size: int = 4096):
+        self.patch_size = patch_size
+        self.downsample_ratio = downsample_ratio
+        self.plan = lru_cache(maxsize=cache_size)(self._plan)
+
+    def best_ratio(self, width, height, min_num, max_num, image_size) -> Tuple[int, int]:
+        """Closest tile grid for the image aspect ratio (uncached part of a plan)"""
+        return find_closest_aspect_ratio(
+            width / height, candidate_ratios(min_num, max_num), width, height, image_size)
+
+    def _plan(self, width: int, height: int, geometry) -> TilePlan:
+        crop_ratio = (1, 1)
+        if geometry.crop_mode and (width > geometry.image_size or height > geometry.image_size):
+            crop_ratio = tuple(self.best_ratio(
+                width, height, geometry.min_crops, geometry.max_crops, geometry.image_size))
+
+        boxes = ()
+        if crop_ratio[0] > 1 or crop_ratio[1] > 1:
+            boxes = tile_boxes(crop_ratio, geometry.image_size)
+
+        num_image_tokens = count_image_tokens(
+            crop_ratio, geometry, patch_size=self.patch_size, downsample_ratio=self.downsample_ratio)
+        return TilePlan(crop_ratio, boxes, num_image_tokens)
+
+
+# Shared planner
+TILE_PLANNER = TilePlanner()
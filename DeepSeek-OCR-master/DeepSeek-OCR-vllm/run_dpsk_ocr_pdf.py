@@ -14,7 +14,7 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, STOP_ON_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE, TOKENIZER
 
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
@@ -23,11 +23,15 @@ from deepseek_ocr import DeepseekOCRForCausalLM
 from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from process.ngram_norepeat import no_repeat_ngram_args
+from process.repetition_stop import is_repetition_stop, repetition_stop_args, repetition_stop_token_id
 from process.image_process import DeepseekOCRProcessor
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
+MAX_MODEL_LEN = 8192
+MAX_TOKENS = 8192
+
 
 llm = LLM(
     model=MODEL_PATH,
@@ -35,7 +39,7 @@ llm = LLM(
     block_size=256,
     enforce_eager=False,
     trust_remote_code=True, 
-    max_model_len=8192,
+    max_model_len=MAX_MODEL_LEN,
     swap_space=0,
     max_num_seqs=MAX_CONCURRENCY,
     tensor_parallel_size=1,
@@ -43,12 +47,16 @@ llm = LLM(
     disable_mm_preprocessor_cache=True
 )
 
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+extra_args = no_repeat_ngram_args(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822}) #window for fast；whitelist_token_ids: <td>,</td>
+REPEAT_STOP_TOKEN_ID = repetition_stop_token_id(TOKENIZER)
+if STOP_ON_REPEAT:
+    extra_args.update(repetition_stop_args(stop_token_id=REPEAT_STOP_TOKEN_ID, whitelist_token_ids= {128821, 128822}))
 
 sampling_params = SamplingParams(
     temperature=0.0,
-    max_tokens=8192,
-    logits_processors=logits_processors,
+    max_tokens=MAX_TOKENS,
+    extra_args=extra_args,
+    stop_token_ids=[REPEAT_STOP_TOKEN_ID] if STOP_ON_REPEAT else None,
     skip_special_tokens=False,
     include_stop_str_in_output=True,
 )
@@ -63,7 +71,7 @@ class Colors:
 
 def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
     """
-    pdf2images
+    pdf2images (RGB, built from the raw pixmap samples; image_format is kept for compatibility)
     """
     images = []
     
@@ -71,23 +79,17 @@ def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
     
     zoom = dpi / 72.0
     matrix = fitz.Matrix(zoom, zoom)
+    Image.MAX_IMAGE_PIXELS = None
     
     for page_num in range(pdf_document.page_count):
         page = pdf_document[page_num]
 
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
+        pixmap = page.get_pixmap(matrix=matrix, colorspace=fitz.csRGB, alpha=False)
 
-        if image_format.upper() == "PNG":
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-        else:
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
+        # no PNG encode/decode: PIL copies the RGB rows straight out of the sample buffer
+        samples = pixmap.samples_mv if hasattr(pixmap, "samples_mv") else pixmap.samples
+        img = Image.frombuffer("RGB", (pixmap.width, pixmap.height), samples, "raw", "RGB", pixmap.stride, 1)
+        pixmap = None
         
         images.append(img)
     
@@ -283,10 +285,20 @@ if __name__ == "__main__":
     contents = ''
     draw_images = []
     jdx = 0
-    for output, img in zip(outputs_list, images):
+    repeat_pages = []
+    saved_tokens = 0
+    for page_idx, (output, img) in enumerate(zip(outputs_list, images)):
         content = output.outputs[0].text
 
-        if '<｜end▁of▁sentence｜>' in content: # repeat no eos
+        if is_repetition_stop(output.outputs[0], REPEAT_STOP_TOKEN_ID): # stopped early: repeat
+            repeat_pages.append(page_idx + 1)
+            # decode budget left: max_tokens, capped by the context left after the prompt
+            budget = min(MAX_TOKENS, MAX_MODEL_LEN - len(output.prompt_token_ids))
+            saved_tokens += max(budget - len(output.outputs[0].token_ids), 0)
+            content = content.replace(TOKENIZER.convert_ids_to_tokens(REPEAT_STOP_TOKEN_ID), '')
+            if SKIP_REPEAT:
+                continue
+        elif '<｜end▁of▁sentence｜>' in content: # repeat no eos
             content = content.replace('<｜end▁of▁sentence｜>', '')
         else:
             if SKIP_REPEAT:
@@ -328,3 +340,6 @@ if __name__ == "__main__":
 
     pil_to_pdf_img2pdf(draw_images, pdf_out_path)
 
+    if repeat_pages:
+        print(f'{Colors.YELLOW}Stopped {len(repeat_pages)} repetitive page(s) early {repeat_pages}, saved {saved_tokens} decode tokens{Colors.RESET}')
+
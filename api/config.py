@@ -28,7 +28,12 @@ MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
 
 # PDF Configuration
 MAX_PDF_PAGES = int(os.getenv('MAX_PDF_PAGES', '50'))
-PDF_DPI = int(os.getenv('PDF_DPI', '144'))
+PDF_DPI = os.getenv('PDF_DPI', '144')  # rendering DPI, or 'auto' to render at the resolution preset's tile grid
+PDF_MAX_INFLIGHT_PAGES = int(os.getenv('PDF_MAX_INFLIGHT_PAGES', '16'))  # pages of one PDF submitted concurrently
+PDF_RENDER_PREFETCH = int(os.getenv('PDF_RENDER_PREFETCH', '2'))  # pages rendered ahead of inference
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))  # render processes, 0/1 = in-process
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '8'))  # smaller documents render in-process
+PDF_EXTRACT_EMBEDDED = os.getenv('PDF_EXTRACT_EMBEDDED', 'True').lower() == 'true'  # scanned pages: decode the page image instead of rendering
 
 # Temporary Files Configuration
 TEMP_DIR = Path(os.getenv('TEMP_DIR', 'output'))
@@ -37,6 +42,24 @@ TEMP_DIR.mkdir(exist_ok=True)
 # vLLM Configuration
 VLLM_USE_V1 = os.getenv('VLLM_USE_V1', '0')
 MAX_MODEL_LEN = int(os.getenv('MAX_MODEL_LEN', '8192'))
+# Stop a generation as soon as its output loops instead of decoding up to MAX_MODEL_LEN
+REPETITION_STOP_ENABLED = os.getenv('REPETITION_STOP_ENABLED', 'True').lower() == 'true'
+
+# Multi-query requests: prompts on one image share its decode and vision encoding
+MAX_QUERIES_PER_IMAGE = int(os.getenv('MAX_QUERIES_PER_IMAGE', '16'))  # prompts per /image/queries request
+
+# Preprocessing Pool Configuration (decode/resize/tokenize; 0 workers = background thread)
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', '4'))
+PREPROCESS_QUEUE_SIZE = int(os.getenv('PREPROCESS_QUEUE_SIZE', '64'))
+# Pixel format sent to the engine: uint8 (normalized on the GPU) or float32 (normalized on the CPU)
+PIXEL_TRANSPORT = os.getenv('PIXEL_TRANSPORT', 'uint8')
+
+# Result Cache Configuration (content-addressed, memory LRU + disk tier)
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'True').lower() == 'true'
+RESULT_CACHE_MEMORY_ENTRIES = int(os.getenv('RESULT_CACHE_MEMORY_ENTRIES', '1024'))
+RESULT_CACHE_DIR = Path(os.getenv('RESULT_CACHE_DIR', str(TEMP_DIR / 'result_cache')))
+RESULT_CACHE_DISK_MAX_MB = int(os.getenv('RESULT_CACHE_DISK_MAX_MB', '512'))  # 0 = memory only
+RESULT_CACHE_TTL_SECONDS = int(os.getenv('RESULT_CACHE_TTL_SECONDS', '86400'))  # 1 day
 
 # Supported OCR Modes
 SUPPORTED_MODES = [
@@ -19,6 +19,7 @@ from api.routers import health, ocr
 from api.services.vllm_service import get_inference_service
 from api.services.task_queue import get_task_queue
 from api.utils.apikey_generator import ensure_api_key
+from api.utils.pdf_utils import shutdown_render_pool
 
 
 @asynccontextmanager
@@ -87,6 +88,13 @@ async def lifespan(app: FastAPI):
         await task_queue.stop_worker()
         print("✓ Task queue worker stopped")
     
+    # Stop inference service workers
+    await service.shutdown()
+    print("✓ Inference service workers stopped")
+    
+    # Stop PDF render workers
+    shutdown_render_pool()
+    
     print("✓ Shutdown complete")
     print("=" * 60 + "\n")
 
@@ -1,5 +1,5 @@
 """Request Models"""
-from typing import Optional, Literal
+from typing import Annotated, Optional, Literal, Union
 from pydantic import BaseModel, Field, field_validator
 
 
@@ -66,7 +66,10 @@ class OCRPDFRequest(BaseModel):
     
     # PDF specific options
     max_pages: Optional[int] = Field(None, ge=1, le=100, description="Maximum pages to process")
-    dpi: int = Field(default=144, ge=72, le=300, description="PDF rendering DPI")
+    dpi: Union[Literal["auto"], Annotated[int, Field(ge=72, le=300)]] = Field(
+        default=144,
+        description="PDF rendering DPI, or 'auto' to render each page at the resolution preset's tile grid"
+    )
     
     @field_validator('custom_prompt')
     @classmethod
@@ -23,6 +23,27 @@ class ModelInfoResponse(BaseModel):
     version: str = Field(default="1.0.0", description="API version")
 
 
+class MetricsResponse(BaseModel):
+    """Service metrics response"""
+    metrics: Dict[str, Any] = Field(description="Metric snapshots keyed by metric name")
+    timestamp: datetime = Field(default_factory=datetime.utcnow, description="Snapshot timestamp")
+
+
+class QueryResult(BaseModel):
+    """Result of one prompt of a multi-query request"""
+    mode: str = Field(description="OCR mode of the query")
+    prompt: str = Field(description="Prompt sent to the model")
+    text: str = Field(description="Raw model output (with grounding markers)")
+    prompt_tokens: int = Field(description="Prompt tokens, image tokens included (0 if served from the result cache)")
+    result_cached: bool = Field(description="Whether the text came from the result cache")
+
+
+class MultiQueryResponse(BaseModel):
+    """Response of a multi-query request on one image"""
+    results: list[QueryResult] = Field(description="One result per query, in request order")
+    processing_time: float = Field(description="Processing time in seconds")
+
+
 class TaskStatusResponse(BaseModel):
     """Task status response for async operations"""
     task_id: str = Field(description="Unique task identifier")
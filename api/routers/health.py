@@ -2,8 +2,9 @@
 from fastapi import APIRouter
 from datetime import datetime
 
-from api.models.response import HealthResponse, ModelInfoResponse
+from api.models.response import HealthResponse, ModelInfoResponse, MetricsResponse
 from api.services.vllm_service import get_inference_service
+from api.services.metrics import get_metrics_registry
 
 router = APIRouter(tags=["health"])
 
@@ -55,3 +56,17 @@ async def get_model_info():
     info = service.get_model_info()
     
     return ModelInfoResponse(**info)
+
+
+@router.get("/api/v1/metrics", response_model=MetricsResponse)
+async def get_metrics():
+    """
+    Get service metrics (requires authentication).
+    
+    Returns counters, gauges and histograms (e.g. result cache hits and
+    preprocessing queue depth) for tuning latency/throughput settings.
+    """
+    return MetricsResponse(
+        metrics=get_metrics_registry().snapshot(),
+        timestamp=datetime.utcnow()
+    )
@@ -1,23 +1,41 @@
 """OCR API Endpoints"""
 import asyncio
+import json
 import time
 from pathlib import Path
 from typing import Optional
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, status
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from PIL import Image
 
 from api.models.request import OCRImageRequest, OCRPDFRequest, ResolutionConfig
-from api.models.response import TaskStatusResponse
+from api.models.response import TaskStatusResponse, MultiQueryResponse, QueryResult
 from api.services.vllm_service import get_inference_service
 from api.services.task_queue import get_task_queue
 from api.utils.image_utils import load_image_from_sources, validate_image
-from api.utils.pdf_utils import load_pdf_from_sources, validate_pdf, pdf_to_images_high_quality
+from api.utils.pdf_utils import load_pdf_from_sources, validate_pdf, stream_pdf_images
 from api.utils.zip_utils import create_result_zip, cleanup_temp_files
-from api.config import MAX_FILE_SIZE_BYTES, MAX_PDF_PAGES, PDF_DPI, RESOLUTION_PRESETS
+from api.utils.prompt_builder import build_prompt
+from api.config import MAX_FILE_SIZE_BYTES, MAX_PDF_PAGES, PDF_DPI, PDF_RENDER_PREFETCH, PDF_RENDER_WORKERS, PDF_PARALLEL_MIN_PAGES, PDF_EXTRACT_EMBEDDED, RESOLUTION_PRESETS, MAX_QUERIES_PER_IMAGE
 
 router = APIRouter(prefix="/api/v1/ocr", tags=["ocr"])
 
+# dpi="auto": the tile plan of each page is chosen as if it were rendered at this DPI
+AUTO_REFERENCE_DPI = 144
+
+
+def _parse_dpi(dpi: str) -> Optional[int]:
+    """PDF rendering DPI from the form value; None for 'auto' (render at the resolution preset's tile grid)"""
+    if str(dpi).strip().lower() == "auto":
+        return None
+    try:
+        value = int(dpi)
+    except ValueError:
+        raise ValueError(f"Invalid dpi '{dpi}': expected an integer or 'auto'")
+    if not 72 <= value <= 300:
+        raise ValueError(f"Invalid dpi {value}: must be between 72 and 300")
+    return value
+
 
 def _get_resolution_config(
     resolution_preset: Optional[str],
@@ -81,10 +99,6 @@ async def ocr_image(
         image = await load_image_from_sources(file_bytes, image_base64, image_url)
         validate_image(image)
 
-        # formulate all images to RGB
-        if image.mode in ("RGBA", "P", "LA"):
-            image = image.convert("RGB")
-
         # Get resolution config
         base_size, image_size, crop_mode = _get_resolution_config(resolution_preset, resolution_config)
         
@@ -135,6 +149,208 @@ async def ocr_image(
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+def _parse_queries(queries: str) -> list[tuple[str, str]]:
+    """Parse the `queries` form field into (mode, prompt) pairs"""
+    try:
+        items = json.loads(queries)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"queries must be a JSON array: {e}")
+    if not isinstance(items, list) or not items:
+        raise ValueError("queries must be a non-empty JSON array")
+    if len(items) > MAX_QUERIES_PER_IMAGE:
+        raise ValueError(f"Too many queries: {len(items)} (maximum {MAX_QUERIES_PER_IMAGE})")
+    
+    parsed = []
+    for item in items:
+        if isinstance(item, str):
+            mode, custom_prompt = item, None
+        elif isinstance(item, dict):
+            mode, custom_prompt = item.get("mode", "custom"), item.get("custom_prompt")
+        else:
+            raise ValueError(f"Invalid query: {item!r}")
+        parsed.append((mode, build_prompt(mode, custom_prompt)))
+    return parsed
+
+
+@router.post("/image/queries", response_model=MultiQueryResponse)
+async def ocr_image_queries(
+    file: Optional[UploadFile] = File(None),
+    image_base64: Optional[str] = Form(None),
+    image_url: Optional[str] = Form(None),
+    queries: str = Form(...),
+    resolution_preset: Optional[str] = Form(None),
+    resolution_config: Optional[ResolutionConfig] = Form(None),
+):
+    """
+    Run several prompts on one image (requires authentication).
+    
+    Input options are the same as /image. `queries` is a JSON array whose
+    entries are mode names or `{"mode": "custom", "custom_prompt": "..."}`
+    objects, e.g.
+    `["document_markdown", "figure_parse", {"custom_prompt": "<image>\\nLocate <|ref|>the title<|/ref|> in the image."}]`.
+    
+    The image is decoded once and all prompts are submitted together, so its
+    vision encoding is shared. Returns the raw output of each prompt.
+    """
+    try:
+        file_bytes = None
+        if file:
+            # Pre-check file size before reading
+            if file.size and file.size > MAX_FILE_SIZE_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File too large. Maximum size: {MAX_FILE_SIZE_BYTES / (1024*1024):.0f}MB"
+                )
+            file_bytes = await file.read()
+        
+        parsed_queries = _parse_queries(queries)
+        
+        image = await load_image_from_sources(file_bytes, image_base64, image_url)
+        validate_image(image)
+        
+        base_size, image_size, crop_mode = _get_resolution_config(resolution_preset, resolution_config)
+        
+        service = await get_inference_service()
+        
+        start_time = time.time()
+        outputs = await service.infer_image_queries(
+            image=image,
+            prompts=[prompt for _, prompt in parsed_queries],
+            base_size=base_size,
+            image_size=image_size,
+            crop_mode=crop_mode
+        )
+        
+        results = [
+            QueryResult(
+                mode=mode,
+                prompt=prompt,
+                text=output["text"],
+                prompt_tokens=output["prompt_tokens"],
+                result_cached=output["result_cached"]
+            )
+            for (mode, prompt), output in zip(parsed_queries, outputs)
+        ]
+        return MultiQueryResponse(
+            results=results,
+            processing_time=time.time() - start_time
+        )
+        
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+
+def _sse_event(event: str, data: dict) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/image/stream")
+async def ocr_image_stream(
+    file: Optional[UploadFile] = File(None),
+    image_base64: Optional[str] = Form(None),
+    image_url: Optional[str] = Form(None),
+    mode: str = Form("document_markdown"),
+    custom_prompt: Optional[str] = Form(None),
+    resolution_preset: Optional[str] = Form(None),
+    resolution_config: Optional[ResolutionConfig] = Form(None),
+):
+    """
+    Perform OCR on a single image and stream the output (requires authentication).
+    
+    Input options are the same as /image. The response is a
+    `text/event-stream` of server-sent events:
+    - `delta`: `{"text": "..."}` newly generated text
+    - `done`: `{"task_id": "...", "download_url": "..."}` where the result ZIP
+      (same content as /image) can be downloaded
+    - `error`: `{"message": "..."}` if inference fails mid-stream
+    """
+    try:
+        # Load image from one of the sources
+        file_bytes = None
+        if file:
+            # Pre-check file size before reading
+            if file.size and file.size > MAX_FILE_SIZE_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File too large. Maximum size: {MAX_FILE_SIZE_BYTES / (1024*1024):.0f}MB"
+                )
+            content = await file.read()
+            file_bytes = content
+        
+        image = await load_image_from_sources(file_bytes, image_base64, image_url)
+        validate_image(image)
+
+        # Get resolution config
+        base_size, image_size, crop_mode = _get_resolution_config(resolution_preset, resolution_config)
+        
+        # Get inference service
+        service = await get_inference_service()
+        
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    async def event_stream():
+        try:
+            output_dir = None
+            async for event in service.stream_image(
+                image=image,
+                mode=mode,
+                custom_prompt=custom_prompt,
+                base_size=base_size,
+                image_size=image_size,
+                crop_mode=crop_mode
+            ):
+                if event["event"] == "delta":
+                    yield _sse_event("delta", {"text": event["text"]})
+                else:
+                    output_dir = event["output_dir"]
+            
+            # Package artifacts like the async PDF task (ZIP inside output_dir)
+            timestamp = int(time.time())
+            zip_path = output_dir / f"result_{timestamp}.zip"
+            
+            metadata = {
+                "model": "DeepSeek-OCR",
+                "mode": mode,
+                "resolution": resolution_preset or f"{base_size}x{image_size}",
+                "timestamp": time.time(),
+                "input_info": {
+                    "type": "image",
+                    "size": f"{image.width}x{image.height}"
+                }
+            }
+            
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                create_result_zip,
+                output_dir,
+                zip_path,
+                metadata
+            )
+            
+            task_queue = await get_task_queue()
+            task_id = await task_queue.register_result(output_dir)
+            
+            yield _sse_event("done", {
+                "task_id": task_id,
+                "download_url": f"/api/v1/ocr/task/{task_id}/download"
+            })
+            
+        except Exception as e:
+            yield _sse_event("error", {"message": str(e)})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.post("/pdf")
 async def ocr_pdf(
     file: Optional[UploadFile] = File(None),
@@ -144,7 +360,7 @@ async def ocr_pdf(
     resolution_preset: Optional[str] = Form(None),
     resolution_config: Optional[ResolutionConfig] = Form(None),
     max_pages: Optional[int] = Form(None),
-    dpi: int = Form(PDF_DPI),
+    dpi: str = Form(PDF_DPI),
 ):
     """
     Perform OCR on a PDF document synchronously (requires authentication).
@@ -180,18 +396,24 @@ async def ocr_pdf(
         max_pages_limit = max_pages or MAX_PDF_PAGES
         page_count = validate_pdf(pdf_bytes, max_pages_limit)
         
-        # Convert to images
-        images = pdf_to_images_high_quality(pdf_bytes, dpi)
-        
         # Get resolution config
         base_size, image_size, crop_mode = _get_resolution_config(resolution_preset, resolution_config)
+        render_dpi = _parse_dpi(dpi)
         
         # Get inference service
         service = await get_inference_service()
         
-        # Run inference
+        # Run inference; pages are rendered on demand, pipelined with inference
         output_dir = await service.infer_pdf(
-            images=images,
+            images=stream_pdf_images(
+                pdf_bytes,
+                render_dpi or AUTO_REFERENCE_DPI,
+                prefetch=PDF_RENDER_PREFETCH,
+                workers=PDF_RENDER_WORKERS,
+                min_parallel_pages=PDF_PARALLEL_MIN_PAGES,
+                page_size=None if render_dpi else service.pdf_page_size(base_size, image_size, crop_mode),
+                extract_embedded=PDF_EXTRACT_EMBEDDED
+            ),
             mode=mode,
             custom_prompt=custom_prompt,
             base_size=base_size,
@@ -242,7 +464,7 @@ async def ocr_pdf_async(
     resolution_preset: Optional[str] = Form(None),
     resolution_config: Optional[ResolutionConfig] = Form(None),
     max_pages: Optional[int] = Form(None),
-    dpi: int = Form(PDF_DPI),
+    dpi: str = Form(PDF_DPI),
 ):
     """
     Perform OCR on a PDF document asynchronously (requires authentication).
@@ -273,29 +495,29 @@ async def ocr_pdf_async(
         
         # Get resolution config
         base_size, image_size, crop_mode = _get_resolution_config(resolution_preset, resolution_config)
+        render_dpi = _parse_dpi(dpi)
         
         # Create async task function (not coroutine!)
         async def process_pdf():
             try:
                 # print(f"[Task] Starting PDF processing: {page_count} pages")
                 
-                # Convert to images in executor to avoid blocking
-                # print(f"[Task] Converting PDF to images...")
-                images = await asyncio.get_running_loop().run_in_executor(
-                    None,
-                    pdf_to_images_high_quality,
-                    pdf_bytes,
-                    dpi
-                )
-                # print(f"[Task] Converted {len(images)} images")
-                
                 # Get inference service
                 service = await get_inference_service()
-                # print(f"[Task] Starting OCR inference on {len(images)} pages...")
+                # print(f"[Task] Starting OCR inference on {page_count} pages...")
                 
-                # Run inference
+                # Run inference; pages are rendered on a background thread
+                # while earlier pages are on the GPU
                 output_dir = await service.infer_pdf(
-                    images=images,
+                    images=stream_pdf_images(
+                        pdf_bytes,
+                        render_dpi or AUTO_REFERENCE_DPI,
+                        prefetch=PDF_RENDER_PREFETCH,
+                        workers=PDF_RENDER_WORKERS,
+                        min_parallel_pages=PDF_PARALLEL_MIN_PAGES,
+                        page_size=None if render_dpi else service.pdf_page_size(base_size, image_size, crop_mode),
+                        extract_embedded=PDF_EXTRACT_EMBEDDED
+                    ),
                     mode=mode,
                     custom_prompt=custom_prompt,
                     base_size=base_size,
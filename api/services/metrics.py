@@ -0,0 +1,138 @@
+"""In-Process Service Metrics"""
+import threading
+from typing import Dict, Any, Optional, Sequence
+
+
+class Counter:
+    """Monotonically increasing counter"""
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        """Increase counter by amount"""
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return current value"""
+        with self._lock:
+            return {"type": "counter", "description": self.description, "value": self._value}
+
+
+class Gauge:
+    """Value that can go up and down"""
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        """Set gauge to value"""
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1.0):
+        """Increase gauge by amount"""
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        """Decrease gauge by amount"""
+        with self._lock:
+            self._value -= amount
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return current value"""
+        with self._lock:
+            return {"type": "gauge", "description": self.description, "value": self._value}
+
+
+class Histogram:
+    """Cumulative bucket histogram (Prometheus-style `le` buckets)"""
+
+    def __init__(self, name: str, buckets: Sequence[float], description: str = ""):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self._counts = [0] * len(self.buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Record one observation"""
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            for idx, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    self._counts[idx] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return cumulative bucket counts, count and sum"""
+        with self._lock:
+            buckets = {str(upper_bound): count for upper_bound, count in zip(self.buckets, self._counts)}
+            buckets["+Inf"] = self._count
+            return {
+                "type": "histogram",
+                "description": self.description,
+                "buckets": buckets,
+                "count": self._count,
+                "sum": self._sum,
+            }
+
+
+class MetricsRegistry:
+    """Registry of named metrics; re-registering a name returns the existing metric"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name: str, factory):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        """Get or create a counter"""
+        return self._get_or_create(name, lambda: Counter(name, description))
+
+    def gauge(self, name: str, description: str = "") -> Gauge:
+        """Get or create a gauge"""
+        return self._get_or_create(name, lambda: Gauge(name, description))
+
+    def histogram(
+        self,
+        name: str,
+        buckets: Sequence[float],
+        description: str = ""
+    ) -> Histogram:
+        """Get or create a histogram"""
+        return self._get_or_create(name, lambda: Histogram(name, buckets, description))
+
+    def snapshot(self, prefix: Optional[str] = None) -> Dict[str, Any]:
+        """Return a snapshot of all metrics (optionally filtered by name prefix)"""
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {
+            name: metric.snapshot()
+            for name, metric in sorted(metrics.items())
+            if prefix is None or name.startswith(prefix)
+        }
+
+
+# Global metrics registry
+_registry = MetricsRegistry()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """Get the global metrics registry"""
+    return _registry
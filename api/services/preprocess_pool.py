@@ -0,0 +1,244 @@
+"""CPU Preprocessing Worker Pool"""
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool, ProcessPoolExecutor
+from typing import Any, NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as torch_mp
+from PIL import Image
+
+from api.services.metrics import get_metrics_registry
+from api.services.result_cache import hash_pixels
+
+
+# Histogram buckets
+PREPROCESS_SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+
+class DecodedImage(NamedTuple):
+    """Image decoded by the preprocessing pool"""
+    image: Image.Image      # RGB image (used to save annotated results)
+    pixels: torch.Tensor    # uint8 [H, W, 3], in shared memory when decoded by a worker
+    digest: str             # hash of the decoded pixels (result cache key)
+
+
+# Processor of the executing worker, created once per process
+_processor = None
+_pixel_transport = None
+
+
+def _configure(pixel_transport: Optional[str]):
+    """Select the pixel format the processor hands to the engine (None = DeepSeek-OCR config)"""
+    global _pixel_transport
+    _pixel_transport = pixel_transport
+
+
+def _get_processor():
+    global _processor
+    if _processor is None:
+        # Imported lazily: needs the DeepSeek-OCR path the parent put on sys.path
+        from process.image_process import DeepseekOCRProcessor
+        kwargs = {'pixel_transport': _pixel_transport} if _pixel_transport else {}
+        _processor = DeepseekOCRProcessor(**kwargs)
+    return _processor
+
+
+def _init_worker(pixel_transport: Optional[str] = None):
+    """Worker process initializer"""
+    # One interpreter per core: keep torch from oversubscribing inside workers
+    torch.set_num_threads(1)
+    _configure(pixel_transport)
+    _get_processor()
+
+
+def _warmup() -> bool:
+    return True
+
+
+def _decode_image(payload: Any) -> Tuple[torch.Tensor, str]:
+    """Stage 1: decode encoded bytes (or take decoded pixels), convert to RGB and hash"""
+    if isinstance(payload, torch.Tensor):
+        pixels = payload
+    else:
+        pixels = _image_pixels(Image.open(io.BytesIO(payload)))
+    return pixels, hash_pixels(pixels.numpy())
+
+
+def _image_pixels(image: Image.Image) -> torch.Tensor:
+    """RGB pixels of an image as a uint8 [H, W, 3] tensor"""
+    rgb = image if image.mode == 'RGB' else image.convert('RGB')
+    return torch.from_numpy(np.array(rgb))
+
+
+def _tokenize_image(pixels: torch.Tensor, prompt: str, geometry: Any, digest: Optional[str] = None):
+    """Stage 2: resize/crop/normalize and build the engine multimodal inputs"""
+    image = Image.fromarray(pixels.numpy())
+    return _get_processor().tokenize_with_images(
+        prompt=prompt,
+        images=[image],
+        bos=True,
+        eos=True,
+        cropping=geometry.crop_mode,
+        geometry=geometry,
+        # same digest as the result cache; keys the model's vision embedding cache
+        image_digests=[digest] if digest is not None else None
+    )
+
+
+def _encoded_bytes(image: Image.Image) -> Optional[bytes]:
+    """Original encoded bytes of an image opened from memory and not decoded yet"""
+    fp = getattr(image, 'fp', None)
+    if fp is not None and hasattr(fp, 'getvalue'):
+        return fp.getvalue()
+    return None
+
+
+class PreprocessPool:
+    """
+    Runs image decoding and tokenization off the event loop.
+
+    With `workers > 0` the work runs in spawned worker processes (no GIL
+    contention with the server). Tensors cross the process boundary through
+    torch.multiprocessing's shared-memory reductions, not as pickled data.
+    With `workers == 0` a single background thread is used instead.
+
+    At most `workers + queue_size` jobs are submitted at once; further
+    callers wait for a slot.
+
+    `pixel_transport` selects the processor's pixel format ("float32" or
+    "uint8", see process.image_process.PIXEL_TRANSPORTS).
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        queue_size: int,
+        pixel_transport: Optional[str] = None,
+        name: str = "preprocess"
+    ):
+        self.workers = max(0, workers)
+        self.pixel_transport = pixel_transport
+        self.capacity = max(1, self.workers) + max(0, queue_size)
+        self.executor = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self._pending = 0
+        self._running = 0
+
+        registry = get_metrics_registry()
+        self.busy = registry.gauge(f"{name}_workers_busy", "Preprocessing workers currently running a job")
+        self.utilization = registry.gauge(f"{name}_utilization", "Fraction of preprocessing workers busy")
+        self.queue_depth = registry.gauge(f"{name}_queue_depth", "Preprocessing jobs waiting for a worker")
+        self.duration = registry.histogram(
+            f"{name}_seconds",
+            PREPROCESS_SECONDS_BUCKETS,
+            "Time spent in a preprocessing job (including queueing)"
+        )
+        self.repeated_uniform_views = registry.counter(
+            f"{name}_repeated_uniform_views",
+            "Single-colour tiles with the colour of an earlier tile of the same image; the encoder reuses its embedding"
+        )
+
+    async def start(self):
+        """Create the executor and spawn/warm up the workers"""
+        if self.executor is not None:
+            return
+        # created once: jobs in flight across an executor restart hold its slots
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.capacity)
+
+        if self.workers > 0:
+            # spawn: the parent owns a CUDA context, which must not be forked
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=torch_mp.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.pixel_transport,)
+            )
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*[
+                loop.run_in_executor(self.executor, _warmup)
+                for _ in range(self.workers)
+            ])
+        else:
+            _configure(self.pixel_transport)
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preprocess")
+
+    async def shutdown(self):
+        """Stop the workers"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def decode(self, image: Image.Image) -> DecodedImage:
+        """
+        Decode an image to RGB and hash its pixels.
+
+        Images opened from memory and not yet decoded are shipped as their
+        encoded bytes, so the decode itself happens in the worker. Decoded
+        images (e.g. rendered PDF pages) are copied to an array in a thread,
+        also off the event loop.
+        """
+        payload = _encoded_bytes(image)
+        if payload is None:
+            loop = asyncio.get_running_loop()
+            payload = await loop.run_in_executor(None, _image_pixels, image)
+
+        pixels, digest = await self._run(_decode_image, payload)
+        return DecodedImage(Image.fromarray(pixels.numpy()), pixels, digest)
+
+    async def tokenize(self, decoded: DecodedImage, prompt: str, geometry: Any):
+        """Build the engine multimodal inputs for one decoded image"""
+        features = await self._run(_tokenize_image, decoded.pixels, prompt, geometry, decoded.digest)
+        # [..., images_key, images_color, images_crop_color]
+        crop_colors = features[0][10]
+        crop_colors = crop_colors[crop_colors >= 0]
+        self.repeated_uniform_views.inc(crop_colors.numel() - crop_colors.unique().numel())
+        return features
+
+    async def _run(self, func, *args):
+        if self.slots is None:
+            await self.start()
+
+        start_time = time.perf_counter()
+        self._pending += 1
+        self._update_gauges()
+        waiting = True
+        try:
+            async with self.slots:
+                self._pending -= 1
+                self._running += 1
+                waiting = False
+                self._update_gauges()
+                executor = self.executor
+                try:
+                    if executor is None:
+                        # restarted after a worker died
+                        await self.start()
+                        executor = self.executor
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(executor, func, *args)
+                except BrokenProcessPool:
+                    # A worker died (possibly while a restarted executor warmed up):
+                    # recreate the executor for the next job, unless another failed job already did
+                    if self.executor is not None and executor in (None, self.executor):
+                        broken, self.executor = self.executor, None
+                        broken.shutdown(wait=False, cancel_futures=True)
+                    raise
+                finally:
+                    self._running -= 1
+        finally:
+            if waiting:
+                self._pending -= 1
+            self._update_gauges()
+            self.duration.observe(time.perf_counter() - start_time)
+
+    def _update_gauges(self):
+        workers = max(1, self.workers)
+        busy = min(self._running, workers)
+        self.busy.set(busy)
+        self.utilization.set(busy / workers)
+        self.queue_depth.set(self._pending + self._running - busy)
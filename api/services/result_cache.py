@@ -0,0 +1,256 @@
+"""Content-Addressed OCR Result Cache"""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from api.services.metrics import get_metrics_registry
+
+
+# Bump when the cached text for an identical input may change
+CACHE_KEY_VERSION = b"ocr-result-v1"
+
+
+def hash_pixels(pixels: np.ndarray) -> str:
+    """
+    Digest of decoded pixels, so re-encoded or re-uploaded copies of the same
+    picture share a cache key.
+
+    Args:
+        pixels: Decoded RGB image as a [H, W, 3] uint8 array
+
+    Returns:
+        Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(repr(pixels.shape).encode('ascii'))
+    digest.update(np.ascontiguousarray(pixels).data)
+    return digest.hexdigest()
+
+
+def compute_cache_key(pixel_digest: str, prompt: str, params: Any, namespace: str = "") -> str:
+    """
+    Combine the pixel digest with everything that affects the generated text.
+
+    Args:
+        pixel_digest: Digest of the decoded pixels (see hash_pixels)
+        prompt: Full prompt sent to the model
+        params: Effective resolution parameters (hashed via repr)
+        namespace: Extra discriminator, e.g. the model path
+
+    Returns:
+        Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(CACHE_KEY_VERSION)
+    digest.update(namespace.encode('utf-8'))
+    digest.update(repr(params).encode('utf-8'))
+    digest.update(prompt.encode('utf-8'))
+    digest.update(pixel_digest.encode('ascii'))
+    return digest.hexdigest()
+
+
+class _DiskTier:
+    """Size-bounded on-disk store of result texts with TTL (by file mtime)"""
+
+    def __init__(self, directory: Path, max_bytes: int, ttl_seconds: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[str, Tuple[int, float]] = {}  # key -> (size, mtime)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in self.directory.glob("*/*.txt"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            self._entries[path.stem] = (stat.st_size, stat.st_mtime)
+            self._total_bytes += stat.st_size
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.txt"
+
+    def _forget(self, key: str):
+        size, _ = self._entries.pop(key, (0, 0.0))
+        self._total_bytes -= size
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl_seconds:
+                self._forget(key)
+                return None
+        try:
+            return self._path(key).read_text(encoding='utf-8')
+        except OSError:
+            with self._lock:
+                self._forget(key)
+            return None
+
+    def put(self, key: str, text: str):
+        data = text.encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            old_size, _ = self._entries.get(key, (0, 0.0))
+            self._entries[key] = (len(data), time.time())
+            self._total_bytes += len(data) - old_size
+
+            # Evict oldest entries until back under budget
+            if self._total_bytes > self.max_bytes:
+                for old_key, _ in sorted(self._entries.items(), key=lambda item: item[1][1]):
+                    if self._total_bytes <= self.max_bytes:
+                        break
+                    if old_key != key:
+                        self._forget(old_key)
+
+
+class ResultCache:
+    """
+    Two-tier (memory LRU + disk) cache of OCR result texts with single-flight.
+
+    Concurrent requests for the same key share one computation; the shared
+    computation is cancelled only when every waiter has gone away. Failed
+    computations are not cached.
+    """
+
+    def __init__(
+        self,
+        memory_entries: int,
+        disk_dir: Optional[Path] = None,
+        disk_max_bytes: int = 0,
+        ttl_seconds: int = 86400,
+        name: str = "result_cache"
+    ):
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._disk = (
+            _DiskTier(disk_dir, disk_max_bytes, ttl_seconds)
+            if disk_dir is not None and disk_max_bytes > 0 else None
+        )
+        self._inflight: Dict[str, Tuple[asyncio.Task, list]] = {}
+
+        registry = get_metrics_registry()
+        self.memory_hits = registry.counter(f"{name}_memory_hits", "Results served from the memory tier")
+        self.disk_hits = registry.counter(f"{name}_disk_hits", "Results served from the disk tier")
+        self.misses = registry.counter(f"{name}_misses", "Results that had to be generated")
+        self.coalesced = registry.counter(f"{name}_coalesced", "Requests that joined an identical in-flight generation")
+        self.memory_size = registry.gauge(f"{name}_memory_entries", "Entries held in the memory tier")
+        self.disk_size = registry.gauge(f"{name}_disk_bytes", "Bytes held in the disk tier")
+        if self._disk is not None:
+            self.disk_size.set(self._disk.total_bytes)
+
+    async def get(self, key: str) -> Optional[str]:
+        """Look up a result in memory, then on disk"""
+        text = self._memory.get(key)
+        if text is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits.inc()
+            return text
+
+        if self._disk is not None:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(None, self._disk.get, key)
+            if text is not None:
+                self._remember(key, text)
+                self.disk_hits.inc()
+                return text
+
+        return None
+
+    async def put(self, key: str, text: str):
+        """Store a result in both tiers"""
+        self._remember(key, text)
+        if self._disk is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._disk.put, key, text)
+            except OSError as e:
+                print(f"Warning: failed to write result cache entry: {e}")
+            self.disk_size.set(self._disk.total_bytes)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        """
+        Return the cached result for key, or compute it once for all callers.
+
+        Args:
+            key: Cache key (see compute_cache_key)
+            compute: Coroutine function producing the result text
+
+        Returns:
+            Result text
+        """
+        text = await self.get(key)
+        if text is not None:
+            return text
+
+        if key in self._inflight:
+            self.coalesced.inc()
+            task, waiters = self._inflight[key]
+        else:
+            self.misses.inc()
+            task = asyncio.create_task(self._compute_and_store(key, compute))
+            waiters = []
+            self._inflight[key] = (task, waiters)
+
+        waiter = object()
+        waiters.append(waiter)
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Cancel the shared generation once nobody is waiting for it
+            waiters.remove(waiter)
+            if not waiters and not task.done():
+                task.cancel()
+                # callers arriving from now on start a fresh computation
+                self._forget_inflight(key, task)
+            raise
+
+    async def _compute_and_store(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        try:
+            text = await compute()
+            await self.put(key, text)
+            return text
+        finally:
+            self._forget_inflight(key, asyncio.current_task())
+
+    def _forget_inflight(self, key: str, task: asyncio.Task):
+        """Drop the in-flight entry of key if it still belongs to task"""
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+
+    def _remember(self, key: str, text: str):
+        if self.memory_entries <= 0:
+            return
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+        self.memory_size.set(len(self._memory))
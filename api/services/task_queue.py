@@ -109,6 +109,30 @@ class TaskQueue:
         
         return task_id
     
+    async def register_result(self, result: Path) -> str:
+        """
+        Register an already completed result so it can be downloaded
+        through the task endpoints and is cleaned up after TASK_TTL_SECONDS.
+        
+        Args:
+            result: Output directory containing the result ZIP
+            
+        Returns:
+            Task ID
+        """
+        task_id = str(uuid.uuid4())
+        task = Task(task_id, None)
+        task.status = TaskStatus.COMPLETED
+        task.started_at = task.created_at
+        task.completed_at = datetime.utcnow()
+        task.result = result
+        task.progress = 1.0
+        
+        async with self._lock:
+            self.tasks[task_id] = task
+        
+        return task_id
+    
     async def get_task(self, task_id: str) -> Optional[Task]:
         """Get task by ID"""
         async with self._lock:
@@ -2,9 +2,10 @@
 import os
 import re
 import time
+import uuid
 import asyncio
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator, Callable, Iterable, Tuple, Union
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 from datetime import datetime
@@ -24,7 +25,8 @@ except (AttributeError, TypeError):
 os.environ['VLLM_USE_V1'] = '0'
 
 # Import after environment setup
-from vllm import LLM, SamplingParams
+from vllm import AsyncLLMEngine, SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.model_executor.models.registry import ModelRegistry
 
 # Import from existing codebase
@@ -46,20 +48,50 @@ except Exception as e:
     # Continue without the path - imports may fail but won't crash startup
 
 from deepseek_ocr import DeepseekOCRForCausalLM
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.ngram_norepeat import no_repeat_ngram_args
+from process.repetition_stop import is_repetition_stop, repetition_stop_args, repetition_stop_token_id
+from process.image_process import ImageGeometry, native_size
+from config import TOKENIZER
 
-from api.config import MODEL_PATH, MAX_CONCURRENCY, MAX_MODEL_LEN, BASE_SIZE, IMAGE_SIZE, CROP_MODE
+from api.config import (
+    MODEL_PATH, MAX_CONCURRENCY, MAX_MODEL_LEN, BASE_SIZE, IMAGE_SIZE, CROP_MODE,
+    PDF_MAX_INFLIGHT_PAGES,
+    RESULT_CACHE_ENABLED, RESULT_CACHE_MEMORY_ENTRIES, RESULT_CACHE_DIR,
+    RESULT_CACHE_DISK_MAX_MB, RESULT_CACHE_TTL_SECONDS,
+    PREPROCESS_WORKERS, PREPROCESS_QUEUE_SIZE, PIXEL_TRANSPORT,
+    REPETITION_STOP_ENABLED
+)
+from api.services.metrics import get_metrics_registry
+from api.services.preprocess_pool import PreprocessPool, DecodedImage
+from api.services.result_cache import ResultCache, compute_cache_key
 from api.utils.prompt_builder import build_prompt
-from api.utils.pdf_utils import pil_to_pdf_img2pdf
+from api.utils.pdf_utils import encode_pdf_page, jpeg_pages_to_pdf
 
 
 # Register model
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
+# Forced by the loop detection (repetition_stop_args) when an output loops; replaced by
+# REPETITION_MARKER in the result text
+REPETITION_STOP_TOKEN_ID = repetition_stop_token_id(TOKENIZER)
+REPETITION_STOP_TEXT = TOKENIZER.convert_ids_to_tokens(REPETITION_STOP_TOKEN_ID)
+REPETITION_MARKER = "\n\n[OCR WARNING: repetitive output, generation stopped early]"
+
+
+async def _iterate(items: Iterable[Any]) -> AsyncIterator[Any]:
+    """Async iterator over a plain iterable"""
+    for item in items:
+        yield item
+
 
 class VLLMInferenceService:
-    """Singleton vLLM Inference Service"""
+    """
+    Singleton vLLM Inference Service.
+
+    Wraps a single AsyncLLMEngine. Every image or PDF page is submitted as its
+    own engine request, so concurrent HTTP handlers share one continuous
+    batching loop on the GPU and each handler only awaits its own result.
+    """
     
     _instance = None
     _lock = asyncio.Lock()
@@ -74,15 +106,41 @@ class VLLMInferenceService:
         if self._initialized:
             return
         
-        self.llm = None
-        self.processor = None
+        self.engine = None
         self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        
+        # Repeat uploads (same pixels, prompt and resolution) reuse results
+        self.result_cache = None
+        if RESULT_CACHE_ENABLED:
+            self.result_cache = ResultCache(
+                memory_entries=RESULT_CACHE_MEMORY_ENTRIES,
+                disk_dir=RESULT_CACHE_DIR,
+                disk_max_bytes=RESULT_CACHE_DISK_MAX_MB * 1024 * 1024,
+                ttl_seconds=RESULT_CACHE_TTL_SECONDS
+            )
+        
+        # Decode / resize / tokenize run in worker processes, off the event loop
+        self.preprocess_pool = PreprocessPool(
+            workers=PREPROCESS_WORKERS,
+            queue_size=PREPROCESS_QUEUE_SIZE,
+            pixel_transport=PIXEL_TRANSPORT
+        )
+        
+        registry = get_metrics_registry()
+        self.repetition_stops = registry.counter(
+            "repetition_stops",
+            "Generations stopped early because their output looped"
+        )
+        self.repetition_saved_tokens = registry.counter(
+            "repetition_saved_tokens",
+            "Decode tokens not generated thanks to early repetition stops"
+        )
         self._initialized = True
     
     async def initialize(self):
         """Initialize vLLM model (called once at startup)"""
         async with self._lock:
-            if self.llm is not None:
+            if self.engine is not None:
                 return
             
             print("Initializing vLLM model...")
@@ -90,12 +148,13 @@ class VLLMInferenceService:
             # Initialize in thread pool to avoid blocking
             loop = asyncio.get_event_loop()
             await loop.run_in_executor(None, self._init_model)
+            await self.preprocess_pool.start()
             
             print("vLLM model initialized successfully!")
     
     def _init_model(self):
         """Initialize model (runs in thread pool)"""
-        self.llm = LLM(
+        engine_args = AsyncEngineArgs(
             model=MODEL_PATH,
             hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
             block_size=256,
@@ -108,12 +167,17 @@ class VLLMInferenceService:
             gpu_memory_utilization=0.9,
             disable_mm_preprocessor_cache=True
         )
-        
-        self.processor = DeepseekOCRProcessor()
+        # The background engine loop is started lazily on the first
+        # generate() call, i.e. inside the server's event loop.
+        self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+    
+    async def shutdown(self):
+        """Stop background workers owned by the service"""
+        await self.preprocess_pool.shutdown()
     
     def is_loaded(self) -> bool:
         """Check if model is loaded"""
-        return self.llm is not None
+        return self.engine is not None
     
     async def infer_image(
         self,
@@ -149,9 +213,7 @@ class VLLMInferenceService:
             (output_dir / "images").mkdir(exist_ok=True)
             
             # Use defaults if not specified
-            base_size = base_size or BASE_SIZE
-            image_size = image_size or IMAGE_SIZE
-            crop_mode = crop_mode if crop_mode is not None else CROP_MODE
+            geometry = self._resolve_geometry(base_size, image_size, crop_mode)
             
             # Build prompt
             prompt = build_prompt(mode, custom_prompt)
@@ -159,33 +221,18 @@ class VLLMInferenceService:
             # Process image
             start_time = time.time()
             
-            # Tokenize image
-            if '<image>' in prompt:
-                image_features = self.processor.tokenize_with_images(
-                    prompt=prompt,  # Pass the prompt parameter
-                    images=[image.convert('RGB')],
-                    bos=True,
-                    eos=True,
-                    cropping=crop_mode
-                )
-            else:
-                image_features = ''
+            # Decode image (in the preprocessing pool)
+            decoded = await self.preprocess_pool.decode(image)
             
-            # Run inference
-            loop = asyncio.get_event_loop()
-            result_text = await loop.run_in_executor(
-                None,
-                self._run_inference,
-                image_features,
-                prompt
-            )
+            # Run inference (or reuse a cached / in-flight identical request)
+            result_text = await self._generate(decoded, prompt, geometry)
             
             processing_time = time.time() - start_time
             
             # Save results
             if '<image>' in prompt:
                 self._save_image_results(
-                    image=image,
+                    image=decoded.image,
                     result_text=result_text,
                     output_dir=output_dir
                 )
@@ -197,9 +244,161 @@ class VLLMInferenceService:
             # Return output directory
             return output_dir
     
+    async def stream_image(
+        self,
+        image: Image.Image,
+        mode: str,
+        custom_prompt: Optional[str] = None,
+        base_size: Optional[int] = None,
+        image_size: Optional[int] = None,
+        crop_mode: Optional[bool] = None,
+        output_dir: Optional[Path] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Run OCR inference on a single image, streaming text as it is generated.
+        
+        Args: same as infer_image
+            
+        Yields:
+            {"event": "delta", "text": str} for each newly generated piece of
+            text, then {"event": "done", "output_dir": Path} once results
+            have been saved
+        """
+        async with self.semaphore:
+            # Create output directory
+            if output_dir is None:
+                timestamp = int(time.time() * 1000)
+                output_dir = Path("output") / f"stream_{timestamp}"
+            output_dir.mkdir(parents=True, exist_ok=True)
+            (output_dir / "images").mkdir(exist_ok=True)
+            
+            # Use defaults if not specified
+            geometry = self._resolve_geometry(base_size, image_size, crop_mode)
+            
+            # Build prompt
+            prompt = build_prompt(mode, custom_prompt)
+            
+            # Decode image (in the preprocessing pool)
+            decoded = await self.preprocess_pool.decode(image)
+            
+            cache_key = self._cache_key(decoded, prompt, geometry)
+            cached_text = None
+            if cache_key is not None:
+                cached_text = await self.result_cache.get(cache_key)
+            
+            if cached_text is not None:
+                # Cached result is sent as a single delta
+                result_text = cached_text
+                if result_text:
+                    yield {"event": "delta", "text": result_text}
+            else:
+                # Tokenize image
+                image_features = await self._tokenize(decoded, prompt, geometry)
+                
+                # Stream deltas
+                result_text = ''
+                async for full_text in self._stream_inference(image_features, prompt):
+                    delta = full_text[len(result_text):]
+                    result_text = full_text
+                    if delta:
+                        yield {"event": "delta", "text": delta}
+                
+                if cache_key is not None:
+                    await self.result_cache.put(cache_key, result_text)
+            
+            # Save results
+            if '<image>' in prompt:
+                self._save_image_results(
+                    image=decoded.image,
+                    result_text=result_text,
+                    output_dir=output_dir
+                )
+            else:
+                # Text-only results
+                with open(output_dir / "result.mmd", 'w', encoding='utf-8') as f:
+                    f.write(result_text)
+            
+            yield {"event": "done", "output_dir": output_dir}
+    
+    async def infer_image_queries(
+        self,
+        image: Image.Image,
+        prompts: List[str],
+        base_size: Optional[int] = None,
+        image_size: Optional[int] = None,
+        crop_mode: Optional[bool] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Run several prompts on one image, sharing its decode and vision encoding.
+        
+        The image is decoded once and all uncached prompts are submitted
+        together. With the model's vision embedding cache on (EMBED_CACHE_MB),
+        prompts scheduled in the same engine step share one vision encoder
+        pass and prompts scheduled later take the cached features. Every prompt submitted to the engine holds its
+        own concurrency slot.
+        
+        Args:
+            image: PIL Image object
+            prompts: Prompts built with build_prompt, in request order
+            base_size, image_size, crop_mode: as in infer_image
+            
+        Returns:
+            One {"text", "prompt_tokens", "result_cached"} dict per prompt
+        """
+        async with self.semaphore:
+            geometry = self._resolve_geometry(base_size, image_size, crop_mode)
+            decoded = await self.preprocess_pool.decode(image)
+            
+            results: List[Optional[Dict[str, Any]]] = [None] * len(prompts)
+            pending = []
+            for idx, prompt in enumerate(prompts):
+                cache_key = self._cache_key(decoded, prompt, geometry)
+                cached_text = await self.result_cache.get(cache_key) if cache_key is not None else None
+                if cached_text is not None:
+                    results[idx] = {"text": cached_text, "prompt_tokens": 0, "result_cached": True}
+                else:
+                    pending.append((idx, prompt, cache_key))
+            if not pending:
+                return results
+            
+            features = await asyncio.gather(*[
+                self._tokenize(decoded, prompt, geometry) for _, prompt, _ in pending
+            ])
+        
+        async def run(idx: int, prompt: str, cache_key: Optional[str], image_features):
+            request_output = None
+            # one slot per engine request, like every other endpoint
+            async with self.semaphore:
+                async for request_output in self._stream_outputs(image_features, prompt):
+                    pass
+            if request_output is None or not request_output.outputs:
+                raise RuntimeError("Model returned empty results")
+            
+            text = self._output_text(request_output.outputs[0])
+            if cache_key is not None:
+                await self.result_cache.put(cache_key, text)
+            results[idx] = {
+                "text": text,
+                "prompt_tokens": len(request_output.prompt_token_ids or []),
+                "result_cached": False
+            }
+        
+        tasks = [
+            asyncio.create_task(run(*item, image_features))
+            for item, image_features in zip(pending, features)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # cancelled generations are aborted inside the engine
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        return results
+    
     async def infer_pdf(
         self,
-        images: List[Image.Image],
+        images: Union[Iterable[Image.Image], AsyncIterator[Image.Image]],
         mode: str,
         custom_prompt: Optional[str] = None,
         base_size: Optional[int] = None,
@@ -210,8 +409,13 @@ class VLLMInferenceService:
         """
         Run OCR inference on PDF pages (multiple images).
         
+        Pages are pulled from `images` only while fewer than
+        PDF_MAX_INFLIGHT_PAGES are in flight, and each page image is released
+        once its results are saved, so with a lazy renderer (stream_pdf_images)
+        memory depends on the pipeline depth rather than the page count.
+        
         Args:
-            images: List of PIL Image objects (PDF pages)
+            images: PIL Image objects (PDF pages), as a list or an async iterator
             mode: OCR mode
             custom_prompt: Custom prompt (if mode='custom')
             base_size: Base image size
@@ -222,120 +426,212 @@ class VLLMInferenceService:
         Returns:
             Path to output directory containing results
         """
-        # Add semaphore control to prevent GPU memory overflow
-        async with self.semaphore:
-            # Create output directory
-            if output_dir is None:
-                timestamp = int(time.time() * 1000)
-                output_dir = Path("output") / f"pdf_{timestamp}"
-            output_dir.mkdir(parents=True, exist_ok=True)
-            (output_dir / "images").mkdir(exist_ok=True)
+        # Create output directory
+        if output_dir is None:
+            timestamp = int(time.time() * 1000)
+            output_dir = Path("output") / f"pdf_{timestamp}"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        (output_dir / "images").mkdir(exist_ok=True)
         
         # Use defaults if not specified
-        base_size = base_size or BASE_SIZE
-        image_size = image_size or IMAGE_SIZE
-        crop_mode = crop_mode if crop_mode is not None else CROP_MODE
+        geometry = self._resolve_geometry(base_size, image_size, crop_mode)
         
         # Build prompt
         prompt = build_prompt(mode, custom_prompt)
         
         start_time = time.time()
         
-        # Process all pages
-        all_results = []
-        for page_idx, image in enumerate(images):
+        # Pages in flight for this document, from rendering until their
+        # results are saved; the service-wide semaphore still bounds the
+        # total number of engine requests across all callers.
+        page_slots = asyncio.Semaphore(PDF_MAX_INFLIGHT_PAGES)
+        with_images = '<image>' in prompt
+        
+        async def process_page(page_idx: int, image: Image.Image) -> tuple:
             try:
-                # print(f"[VLLMService] Processing page {page_idx + 1}/{len(images)}")
-                
-                # Tokenize image
-                if '<image>' in prompt:
-                    image_features = self.processor.tokenize_with_images(
-                        prompt=prompt,  # Pass the prompt parameter
-                        images=[image.convert('RGB')],
-                        bos=True,
-                        eos=True,
-                        cropping=crop_mode
-                    )
-                else:
-                    image_features = ''
+                async with self.semaphore:
+                    try:
+                        decoded = await self.preprocess_pool.decode(image)
+                        
+                        # Run inference with timeout per page
+                        result_text = await asyncio.wait_for(
+                            self._generate(decoded, prompt, geometry),
+                            timeout=120  # 2 minutes per page (reduced from 5 minutes)
+                        )
+                        
+                    except asyncio.TimeoutError:
+                        print(f"Warning: Page {page_idx + 1} timed out, skipping")
+                        # Add error marker for this page
+                        result_text = f"[OCR ERROR: Page {page_idx + 1} processing timed out]"
+                        
+                    except Exception as e:
+                        print(f"Warning: Page {page_idx + 1} failed with error: {e}")
+                        # Add error marker for this page
+                        result_text = f"[OCR ERROR: Page {page_idx + 1} failed: {str(e)}]"
                 
-                # Run inference with timeout per page
-                result_text = await asyncio.wait_for(
-                    asyncio.get_running_loop().run_in_executor(
-                        None,
-                        self._run_inference,
-                        image_features,
-                        prompt
-                    ),
-                    timeout=120  # 2 minutes per page (reduced from 5 minutes)
+                # Save this page's outputs now, so its image can be released
+                return await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    self._save_pdf_page,
+                    page_idx,
+                    image,
+                    result_text,
+                    output_dir,
+                    with_images
                 )
-                
-                all_results.append((page_idx, image, result_text))
-                # print(f"[VLLMService] Page {page_idx + 1} completed")
-                
-            except asyncio.TimeoutError:
-                print(f"Warning: Page {page_idx + 1} timed out, skipping")
-                # Add error marker for this page
-                all_results.append((page_idx, image, f"[OCR ERROR: Page {page_idx + 1} processing timed out]"))
-                
-            except Exception as e:
-                print(f"Warning: Page {page_idx + 1} failed with error: {e}")
-                # Add error marker for this page
-                all_results.append((page_idx, image, f"[OCR ERROR: Page {page_idx + 1} failed: {str(e)}]"))
+            finally:
+                page_slots.release()
+        
+        # Pull pages (rendered lazily when `images` is an async iterator)
+        # only when a slot is free, and submit each one as soon as it arrives
+        pages = images if hasattr(images, "__anext__") else _iterate(images)
+        page_tasks = []
+        try:
+            while True:
+                await page_slots.acquire()
+                try:
+                    image = await pages.__anext__()
+                except StopAsyncIteration:
+                    page_slots.release()
+                    break
+                except BaseException:
+                    page_slots.release()
+                    raise
+                page_tasks.append(asyncio.create_task(process_page(len(page_tasks), image)))
+                image = None
+            
+            all_results = await asyncio.gather(*page_tasks)
+        finally:
+            # Abort remaining pages if the caller gives up (e.g. task timeout)
+            for page_task in page_tasks:
+                page_task.cancel()
+            if hasattr(pages, "aclose"):
+                await pages.aclose()
         
         processing_time = time.time() - start_time
         # print(f"[VLLMService] All pages processed in {processing_time:.2f}s, saving results...")
         
         # Save merged results
-        self._save_pdf_results(
-            results=all_results,
-            output_dir=output_dir,
-            with_images='<image>' in prompt
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            self._write_pdf_results,
+            all_results,
+            output_dir,
+            with_images
         )
         
         # print(f"[VLLMService] Results saved to {output_dir}")
         return output_dir
     
-    def _run_inference(self, image_features, prompt: str) -> str:
-        """Run synchronous inference (called in executor)"""
-        # print(f"[DEBUG] _run_inference called")
-        # print(f"[DEBUG] prompt = {repr(prompt)}")
-        # print(f"[DEBUG] '<image>' in prompt = {'<image>' in prompt}")
-        # print(f"[DEBUG] image_features type = {type(image_features)}")
-        # if image_features:
-        #     print(f"[DEBUG] image_features length = {len(image_features)}")
-        #     if isinstance(image_features, list) and len(image_features) > 0:
-        #         print(f"[DEBUG] image_features[0] length = {len(image_features[0])}")
-        #         # 新增：打印image_features[0]的详细信息
-        #         input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes = image_features[0]
-        #         print(f"[DEBUG] input_ids shape = {input_ids.shape}")
-        #         print(f"[DEBUG] pixel_values shape = {pixel_values.shape}")
-        #         print(f"[DEBUG] images_crop shape = {images_crop.shape}")
-        #         print(f"[DEBUG] images_spatial_crop = {images_spatial_crop}")
-        #         print(f"[DEBUG] num_image_tokens = {num_image_tokens}")
-        #         print(f"[DEBUG] image_shapes = {image_shapes}")
-        #         # 统计input_ids中image token的数量
-        #         image_token_id = self.processor.image_token_id
-        #         image_token_count = (input_ids == image_token_id).sum().item()
-        #         print(f"[DEBUG] image_token_id = {image_token_id}")
-        #         print(f"[DEBUG] image tokens in input_ids = {image_token_count}")        
-    
-        logits_processors = [
-            NoRepeatNGramLogitsProcessor(
-                ngram_size=20,
-                window_size=50,
-                whitelist_token_ids={128821, 128822}
+    def _build_sampling_params(self) -> SamplingParams:
+        """Build sampling parameters for a single engine request"""
+        # Settings only: the model applies them to the whole batch in compute_logits
+        extra_args = no_repeat_ngram_args(
+            ngram_size=20,
+            window_size=50,
+            whitelist_token_ids={128821, 128822}
+        )
+        stop_token_ids = None
+        if REPETITION_STOP_ENABLED:
+            extra_args.update(
+                repetition_stop_args(
+                    stop_token_id=REPETITION_STOP_TOKEN_ID,
+                    whitelist_token_ids={128821, 128822}
+                )
             )
-        ]
+            stop_token_ids = [REPETITION_STOP_TOKEN_ID]
         
-        sampling_params = SamplingParams(
+        return SamplingParams(
             temperature=0.0,
             max_tokens=MAX_MODEL_LEN,
-            logits_processors=logits_processors,
+            extra_args=extra_args,
+            stop_token_ids=stop_token_ids,
             skip_special_tokens=False,
             include_stop_str_in_output=True,
         )
+    
+    def pdf_page_size(
+        self,
+        base_size: Optional[int] = None,
+        image_size: Optional[int] = None,
+        crop_mode: Optional[bool] = None,
+        reference_dpi: int = 144
+    ) -> Callable[[float, float], Tuple[int, int]]:
+        """
+        Page sizing for dpi="auto" (stream_pdf_images page_size).
+        
+        Each page is rasterized, at its own aspect ratio, at the size the
+        processor works at for this geometry (native_size): covering the tile
+        grid when the page is tiled, else the global view. The tile plan is the one the
+        page would get at `reference_dpi`, so only the raster size changes.
+        """
+        geometry = self._resolve_geometry(base_size, image_size, crop_mode)
+        zoom = reference_dpi / 72.0
+        
+        def page_size(width: float, height: float) -> Tuple[int, int]:
+            return native_size(width * zoom, height * zoom, geometry)
+        return page_size
+    
+    def _resolve_geometry(
+        self,
+        base_size: Optional[int],
+        image_size: Optional[int],
+        crop_mode: Optional[bool]
+    ) -> ImageGeometry:
+        """Build the per-request processor geometry, filling in config defaults"""
+        return ImageGeometry(
+            base_size=base_size or BASE_SIZE,
+            image_size=image_size or IMAGE_SIZE,
+            crop_mode=crop_mode if crop_mode is not None else CROP_MODE
+        )
+    
+    def _cache_key(self, decoded: DecodedImage, prompt: str, geometry: ImageGeometry) -> Optional[str]:
+        """Result cache key for one image request (None if caching is disabled)"""
+        if self.result_cache is None:
+            return None
+        # settings that change the generated text for the same pixels and prompt
+        params = (geometry, PIXEL_TRANSPORT, REPETITION_STOP_ENABLED, MAX_MODEL_LEN)
+        return compute_cache_key(decoded.digest, prompt, params, namespace=MODEL_PATH)
+    
+    async def _generate(
+        self,
+        decoded: DecodedImage,
+        prompt: str,
+        geometry: ImageGeometry
+    ) -> str:
+        """
+        Produce the result text for one image, going through the result cache.
+        
+        Identical concurrent requests share one generation.
+        """
+        async def compute() -> str:
+            image_features = await self._tokenize(decoded, prompt, geometry)
+            return await self._run_inference(image_features, prompt)
         
+        cache_key = self._cache_key(decoded, prompt, geometry)
+        if cache_key is None:
+            return await compute()
+        return await self.result_cache.get_or_compute(cache_key, compute)
+    
+    async def _tokenize(self, decoded: DecodedImage, prompt: str, geometry: ImageGeometry):
+        """Tokenize prompt and image into engine multimodal inputs (in the preprocessing pool)"""
+        if '<image>' not in prompt:
+            return ''
+        return await self.preprocess_pool.tokenize(decoded, prompt, geometry)
+    
+    async def _stream_inference(self, image_features, prompt: str) -> AsyncIterator[str]:
+        """
+        Submit one request to the shared engine and yield its cumulative text.
+        
+        Cancelling the consumer (e.g. on timeout or client disconnect) aborts
+        the request inside the engine, so its batch slot is released immediately.
+        """
+        async for request_output in self._stream_outputs(image_features, prompt):
+            if request_output.outputs:
+                yield self._output_text(request_output.outputs[0])
+    
+    async def _stream_outputs(self, image_features, prompt: str) -> AsyncIterator[Any]:
+        """Submit one request to the shared engine and yield its RequestOutputs (aborted if not consumed to the end)"""
         if image_features:
             request = {
                 "prompt": prompt,
@@ -344,10 +640,46 @@ class VLLMInferenceService:
         else:
             request = {"prompt": prompt}
         
-        outputs = self.llm.generate(request, sampling_params)
-        if not outputs or not outputs[0].outputs:
+        request_id = f"ocr-{uuid.uuid4().hex}"
+        finished = False
+        try:
+            async for request_output in self.engine.generate(
+                request,
+                self._build_sampling_params(),
+                request_id
+            ):
+                if request_output.finished:
+                    self._record_repetition_stop(request_output)
+                yield request_output
+            finished = True
+        finally:
+            if not finished:
+                await self.engine.abort(request_id)
+    
+    def _output_text(self, output) -> str:
+        """Result text of a CompletionOutput, marked if the repetition detector stopped it"""
+        if is_repetition_stop(output, REPETITION_STOP_TOKEN_ID):
+            return output.text.replace(REPETITION_STOP_TEXT, '') + REPETITION_MARKER
+        return output.text
+    
+    def _record_repetition_stop(self, request_output):
+        """Count a finished request stopped by the repetition detector and the decode budget it left unused"""
+        if not request_output.outputs or not is_repetition_stop(request_output.outputs[0], REPETITION_STOP_TOKEN_ID):
+            return
+        prompt_tokens = len(request_output.prompt_token_ids or ())
+        budget = MAX_MODEL_LEN - prompt_tokens
+        self.repetition_stops.inc()
+        self.repetition_saved_tokens.inc(max(budget - len(request_output.outputs[0].token_ids), 0))
+    
+    async def _run_inference(self, image_features, prompt: str) -> str:
+        """Submit one request to the shared engine and await its final output"""
+        result_text = None
+        async for result_text in self._stream_inference(image_features, prompt):
+            pass
+        
+        if result_text is None:
             raise RuntimeError("Model returned empty results")
-        return outputs[0].outputs[0].text
+        return result_text
     
     def _save_image_results(
         self,
@@ -384,73 +716,84 @@ class VLLMInferenceService:
         with open(output_dir / "result.mmd", 'w', encoding='utf-8') as f:
             f.write(cleaned_text)
     
-    def _save_pdf_results(
+    def _save_pdf_page(
         self,
-        results: List[tuple],
+        page_idx: int,
+        image: Image.Image,
+        result_text: str,
         output_dir: Path,
         with_images: bool
-    ):
-        """Save OCR results for PDF (multiple pages)"""
-        all_text_ori = []
-        all_text_clean = []
-        annotated_images = []  # Store annotated images for PDF generation
-        
-        for page_idx, image, result_text in results:
-            # Save original
-            all_text_ori.append(f"# Page {page_idx + 1}\n\n{result_text}\n\n<--- Page Split --->\n\n")
-            
-            if with_images:
-                # Extract references
-                matches_ref, matches_images, matches_other = self._extract_refs(result_text)
-                
-                # Draw bounding boxes on image for visualization
-                if matches_ref:
-                    annotated_image = self._draw_bounding_boxes(image, matches_ref)
-                    annotated_images.append(annotated_image)
-                else:
-                    # No annotations, use original image
-                    annotated_images.append(image.copy())
-                
-                # Extract embedded images with page prefix
-                if matches_images:
-                    self._extract_embedded_images(
-                        image,
-                        matches_images,
-                        output_dir / "images",
-                        prefix=f"{page_idx}_"
-                    )
-                
-                # Clean result
-                cleaned_text = result_text
-                
-                for idx, match in enumerate(matches_images):
-                    cleaned_text = cleaned_text.replace(
-                        match,
-                        f'![](images/{page_idx}_{idx}.jpg)\n'
-                    )
-                
-                for match in matches_other:
-                    cleaned_text = cleaned_text.replace(match, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
-                
-                all_text_clean.append(f"# Page {page_idx + 1}\n\n{cleaned_text}\n\n<--- Page Split --->\n\n")
-            else:
-                all_text_clean.append(f"# Page {page_idx + 1}\n\n{result_text}\n\n<--- Page Split --->\n\n")
+    ) -> tuple:
+        """
+        Save the per-page outputs of one PDF page (embedded images) and build its merged-file parts.
+        
+        Returns:
+            (original text, cleaned text, annotated page as JPEG bytes or None);
+            nothing refers to the page image afterwards
+        """
+        # Save original
+        text_ori = f"# Page {page_idx + 1}\n\n{result_text}\n\n<--- Page Split --->\n\n"
         
+        if not with_images:
+            return text_ori, text_ori, None
+        
+        # Extract references
+        matches_ref, matches_images, matches_other = self._extract_refs(result_text)
+        
+        # Draw bounding boxes on image for visualization
+        if matches_ref:
+            annotated_page = encode_pdf_page(self._draw_bounding_boxes(image, matches_ref))
+        else:
+            # No annotations, use original image
+            annotated_page = encode_pdf_page(image)
+        
+        # Extract embedded images with page prefix
+        if matches_images:
+            self._extract_embedded_images(
+                image,
+                matches_images,
+                output_dir / "images",
+                prefix=f"{page_idx}_"
+            )
+        
+        # Clean result
+        cleaned_text = result_text
+        
+        for idx, match in enumerate(matches_images):
+            cleaned_text = cleaned_text.replace(
+                match,
+                f'![](images/{page_idx}_{idx}.jpg)\n'
+            )
+        
+        for match in matches_other:
+            cleaned_text = cleaned_text.replace(match, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+        
+        text_clean = f"# Page {page_idx + 1}\n\n{cleaned_text}\n\n<--- Page Split --->\n\n"
+        return text_ori, text_clean, annotated_page
+    
+    def _write_pdf_results(
+        self,
+        pages: List[tuple],
+        output_dir: Path,
+        with_images: bool
+    ):
+        """Write the merged results of a PDF from the per-page parts of _save_pdf_page, in page order"""
         # Save merged files
         # print(f"[VLLMService] Writing result_ori.mmd...")
         with open(output_dir / "result_ori.mmd", 'w', encoding='utf-8') as f:
-            f.write(''.join(all_text_ori))
+            f.write(''.join(text_ori for text_ori, _, _ in pages))
         
         # print(f"[VLLMService] Writing result.mmd...")
         with open(output_dir / "result.mmd", 'w', encoding='utf-8') as f:
-            f.write(''.join(all_text_clean))
+            f.write(''.join(text_clean for _, text_clean, _ in pages))
         
         # Generate annotated PDF if we have annotated images
-        if annotated_images and with_images:
-            # print(f"[VLLMService] Generating annotated PDF with {len(annotated_images)} pages...")
+        annotated_pages = [page for _, _, page in pages if page is not None]
+        if annotated_pages and with_images:
+            # print(f"[VLLMService] Generating annotated PDF with {len(annotated_pages)} pages...")
             pdf_output_path = output_dir / "result_layouts.pdf"
             try:
-                pil_to_pdf_img2pdf(annotated_images, pdf_output_path)
+                jpeg_pages_to_pdf(annotated_pages, pdf_output_path)
                 # print(f"[VLLMService] Annotated PDF created: {pdf_output_path}")
             except Exception as e:
                 print(f"[VLLMService] Warning: Failed to create annotated PDF: {e}")
@@ -1,13 +1,52 @@
 """PDF Processing Utilities"""
+import asyncio
+import atexit
 import io
+import math
+import multiprocessing as mp
+import threading
 import httpx
 import img2pdf
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import List, Union, Optional
+from typing import AsyncIterator, Callable, Iterator, List, Tuple, Union, Optional
 import fitz  # PyMuPDF
 from PIL import Image
 
 
+# Process pool shared by all parallel renders (created on first use)
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_pool_lock = threading.Lock()
+
+# Render worker state: (shared memory name, SharedMemory, buffer view, open document)
+_worker_document = None
+
+# Maps a page size in points to the (width, height) in pixels to render it at
+PageSizeFn = Callable[[float, float], Tuple[int, int]]
+
+# A page whose only image covers it at least this closely (area ratio) is taken from that image
+EMBEDDED_PAGE_COVERAGE = 0.98
+
+# Transposes turning a stored image into its displayed orientation, keyed on
+# the signs of the image-to-page matrix: (a > 0, d > 0) when upright or
+# flipped, (b > 0, c > 0) when turned sideways
+_UPRIGHT_TRANSPOSES = {
+    (True, True): (),
+    (False, True): (Image.Transpose.FLIP_LEFT_RIGHT,),
+    (True, False): (Image.Transpose.FLIP_TOP_BOTTOM,),
+    (False, False): (Image.Transpose.ROTATE_180,),
+}
+_SIDEWAYS_TRANSPOSES = {
+    (True, True): (Image.Transpose.TRANSPOSE,),
+    (True, False): (Image.Transpose.ROTATE_270,),
+    (False, True): (Image.Transpose.ROTATE_90,),
+    (False, False): (Image.Transpose.TRANSVERSE,),
+}
+
+
 async def load_pdf_from_sources(
     file_bytes: Optional[bytes] = None,
     url: Optional[str] = None,
@@ -74,87 +113,455 @@ def validate_pdf(pdf_bytes: bytes, max_pages: Optional[int] = None) -> int:
         raise ValueError(f"Failed to validate PDF: {str(e)}")
 
 
-def pdf_to_images_high_quality(pdf_bytes: bytes, dpi: int = 144) -> List[Image.Image]:
+def pixmap_to_image(pix: "fitz.Pixmap") -> Image.Image:
     """
-    Convert PDF pages to high-quality images.
+    Build a PIL image straight from a pixmap's raw samples (no PNG round-trip).
     
     Args:
-        pdf_bytes: PDF file bytes
-        dpi: Resolution for rendering (default: 144)
+        pix: RGB pixmap without alpha (get_pixmap(colorspace=fitz.csRGB, alpha=False))
         
     Returns:
-        List of PIL Image objects (one per page)
+        RGB PIL Image; it owns its pixels, so the pixmap can be released
         
     Raises:
-        ValueError: If conversion fails
+        ValueError: If the pixmap is not 3-channel RGB
     """
-    doc = None
-    try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        images = []
+    if pix.n != 3 or pix.alpha:
+        raise ValueError(f"Expected an RGB pixmap without alpha, got {pix.n} channels (alpha={pix.alpha})")
+    
+    # samples_mv avoids the bytes copy of pix.samples (PyMuPDF >= 1.18.17)
+    samples = pix.samples_mv if hasattr(pix, "samples_mv") else pix.samples
+    return _samples_to_image(pix.width, pix.height, pix.stride, samples)
+
+
+def _samples_to_image(width: int, height: int, stride: int, samples) -> Image.Image:
+    # PIL unpacks 3-byte RGB rows into its own storage, honouring the stride
+    return Image.frombuffer("RGB", (width, height), samples, "raw", "RGB", stride, 1)
+
+
+def iter_pdf_images(
+    pdf_bytes: bytes,
+    dpi: int = 144,
+    workers: int = 0,
+    min_parallel_pages: int = 8,
+    page_size: Optional[PageSizeFn] = None,
+    extract_embedded: bool = False
+) -> Iterator[Image.Image]:
+    """
+    Render PDF pages one at a time, in page order.
+    
+    Only the pages being rendered are held; the document is closed when the
+    generator is exhausted or closed. With workers > 1, documents of at
+    least `min_parallel_pages` pages are rendered by a pool of worker
+    processes (see _iter_pdf_images_parallel); smaller ones are rendered
+    in-process, where the pool round-trips would cost more than they save.
+    
+    Args:
+        pdf_bytes: PDF file bytes
+        dpi: Resolution for rendering (default: 144)
+        workers: Render processes (0 or 1 = render in-process)
+        min_parallel_pages: Smallest page count rendered by the pool
+        page_size: Pixel size per page from its size in points (e.g. to
+            land on a tile grid); overrides `dpi`
+        extract_embedded: Take scanned pages (one image covering the page)
+            from their embedded image instead of rendering them (see
+            _embedded_page_image)
         
-        # Calculate zoom factor for desired DPI
-        zoom = dpi / 72.0  # 72 is default DPI
-        mat = fitz.Matrix(zoom, zoom)
+    Yields:
+        RGB PIL Image per page
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        if workers > 1 and len(doc) >= min_parallel_pages:
+            zooms = [_page_zoom(doc.load_page(page_num), dpi, page_size) for page_num in range(len(doc))]
+            doc.close()
+            doc = None
+            yield from _iter_pdf_images_parallel(pdf_bytes, zooms, workers, extract_embedded)
+            return
         
         for page_num in range(len(doc)):
             page = doc.load_page(page_num)
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Convert to PIL Image
-            img_data = pix.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            images.append(img)
-            
-            # Clean up pixmap to prevent memory leak
-            pix = None
+            image = _render_page(page, _page_zoom(page, dpi, page_size), extract_embedded)
             page = None
-        
-        return images
-    except Exception as e:
-        raise ValueError(f"Failed to convert PDF to images: {str(e)}")
+            yield image
     finally:
         # Ensure document is always closed
         if doc is not None:
             try:
                 doc.close()
-                doc = None
             except Exception as e:
                 print(f"Warning: Failed to close PDF document: {e}")
-                pass
 
 
-def pil_to_pdf_img2pdf(pil_images: List[Image.Image], output_path: Path):
+def _page_zoom(page: "fitz.Page", dpi: int, page_size: Optional[PageSizeFn]) -> Tuple[float, float]:
+    """Horizontal and vertical zoom to render a page at"""
+    if page_size is None:
+        # Calculate zoom factor for desired DPI
+        zoom = dpi / 72.0  # 72 is default DPI
+        return zoom, zoom
+    
+    # page.rect is the displayed (rotated) page; the pixmap size is exactly the product
+    width, height = page_size(page.rect.width, page.rect.height)
+    return width / page.rect.width, height / page.rect.height
+
+
+def _render_page(page: "fitz.Page", zoom: Tuple[float, float], extract_embedded: bool) -> Image.Image:
+    """Render one page in-process (or take it from its embedded image)"""
+    image = _embedded_page_image(page, zoom) if extract_embedded else None
+    if image is None:
+        pix = page.get_pixmap(matrix=fitz.Matrix(*zoom), colorspace=fitz.csRGB, alpha=False)
+        image = pixmap_to_image(pix)
+        # Clean up pixmap to prevent memory leak
+        pix = None
+    return image
+
+
+def _embedded_page_image(page: "fitz.Page", zoom: Tuple[float, float]) -> Optional[Image.Image]:
     """
-    Convert PIL images to a single PDF file.
+    Pixels of a scanned page taken straight from its only image; None if the page has to be rendered.
+    
+    A page qualifies when a single opaque image, placed once, covers it and
+    nothing else is drawn (vector graphics, visible text, annotations;
+    invisible OCR text layers are fine). The image is decoded at native
+    resolution, reduced by powers of two while it stays at least the render
+    size (JPEG draft decoding, pixmap shrink), and turned to the displayed
+    orientation of the page (image placement and page rotation).
+    """
+    try:
+        images = page.get_images(full=True)
+        if len(images) != 1 or images[0][1]:  # one image, without soft mask
+            return None
+        xref = images[0][0]
+        doc = page.parent
+        if doc.xref_get_key(xref, "ImageMask")[1] == "true":
+            return None
+        
+        # get_image_info without xrefs: get_image_rects would decode the image to hash it
+        placements = page.get_image_info()
+        if len(placements) != 1 or placements[0]["has-mask"]:
+            return None
+        placement = placements[0]
+        if (placement["width"], placement["height"]) != (images[0][2], images[0][3]):
+            return None
+        bbox, transform = fitz.Rect(placement["bbox"]), fitz.Matrix(placement["transform"])
+        # image rects are in unrotated page coordinates
+        page_rect = page.rect * page.derotation_matrix
+        page_area = page_rect.get_area()
+        if (
+            page_area <= 0
+            or (bbox & page_rect).get_area() < EMBEDDED_PAGE_COVERAGE * page_area
+            or bbox.get_area() * EMBEDDED_PAGE_COVERAGE > page_area
+        ):
+            return None
+        if page.first_annot is not None or page.get_drawings():
+            return None
+        if any(span["type"] != 3 and span["opacity"] > 0 for span in page.get_texttrace()):
+            return None
+        
+        transposes = _image_transposes(transform * page.rotation_matrix)
+        if transposes is None:
+            return None
+        
+        # render size, in the stored orientation of the image
+        target = (page.rect.width * zoom[0], page.rect.height * zoom[1])
+        if transposes in _SIDEWAYS_TRANSPOSES.values():
+            target = target[::-1]
+        image = _decode_embedded_image(doc, xref, target)
+        if image is None:
+            return None
+        for method in transposes:
+            image = image.transpose(method)
+        return image
+    except Exception as e:
+        print(f"Warning: Failed to extract the embedded image of page {page.number + 1}, rendering it: {e}")
+        return None
+
+
+def _image_transposes(m: "fitz.Matrix") -> Optional[tuple]:
+    """Transposes from stored to displayed orientation for an image-to-page matrix; None if it is skewed"""
+    eps = 1e-3 * max(abs(m.a), abs(m.b), abs(m.c), abs(m.d))
+    if abs(m.b) <= eps and abs(m.c) <= eps:
+        return _UPRIGHT_TRANSPOSES[(m.a > 0, m.d > 0)]
+    if abs(m.a) <= eps and abs(m.d) <= eps:
+        return _SIDEWAYS_TRANSPOSES[(m.b > 0, m.c > 0)]
+    return None
+
+
+def _decode_embedded_image(doc: "fitz.Document", xref: int, target: Tuple[float, float]) -> Optional[Image.Image]:
+    """Decode an image XObject to RGB, reduced by powers of two while it stays at least `target` (width, height)"""
+    if doc.xref_get_key(xref, "Filter") == ("name", "/DCTDecode") and doc.xref_get_key(xref, "Decode")[0] == "null":
+        # plain JPEG: PIL decodes it directly, at 1/2, 1/4 or 1/8 scale when that is enough
+        image = Image.open(io.BytesIO(doc.xref_stream_raw(xref)))
+        if image.mode in ("L", "RGB"):
+            image.draft(image.mode, (math.ceil(target[0]), math.ceil(target[1])))
+            return image.convert("RGB")
+    
+    # anything else (JBIG2, CCITT, Flate, CMYK or Decode arrays) is decoded by MuPDF
+    pix = fitz.Pixmap(doc, xref)
+    if pix.colorspace is None:
+        return None
+    scale = min(pix.width / max(target[0], 1), pix.height / max(target[1], 1))
+    if scale >= 2:
+        pix.shrink(int(math.log2(scale)))
+    if pix.alpha or pix.colorspace.n != 3 or pix.colorspace.name != fitz.csRGB.name:
+        pix = fitz.Pixmap(fitz.csRGB, fitz.Pixmap(pix, 0) if pix.alpha else pix)
+    return pixmap_to_image(pix)
+
+
+def _iter_pdf_images_parallel(
+    pdf_bytes: bytes,
+    zooms: List[Tuple[float, float]],
+    workers: int,
+    extract_embedded: bool = False
+) -> Iterator[Image.Image]:
+    """
+    Render pages (zooms: one (zoom_x, zoom_y) per page) across the process pool, yielding them in page order.
+    
+    The PDF is copied once into shared memory, which every worker maps and
+    opens in place. Up to two pages per worker are in flight, so memory
+    does not grow with the page count.
+    
+    If a worker dies (OOM kill, MuPDF crash on a malformed file) the broken
+    pool is dropped, so the next document gets a fresh one, and the rest of
+    this document is rendered in-process.
+    """
+    pool = _get_render_pool(workers)
+    shm = shared_memory.SharedMemory(create=True, size=len(pdf_bytes))
+    pending = deque()
+    page_count = len(zooms)
+    rendered = 0
+    try:
+        shm.buf[:len(pdf_bytes)] = pdf_bytes
+        next_page = 0
+        try:
+            while next_page < page_count or pending:
+                while next_page < page_count and len(pending) < 2 * workers:
+                    pending.append(pool.submit(
+                        _render_shared_page, shm.name, len(pdf_bytes), next_page, zooms[next_page], extract_embedded))
+                    next_page += 1
+                width, height, stride, samples = pending.popleft().result()
+                yield _samples_to_image(width, height, stride, samples)
+                rendered += 1
+        except BrokenProcessPool:
+            _discard_render_pool(pool)
+            print(f"Warning: PDF render worker died, rendering pages {rendered + 1}-{page_count} in-process")
+    finally:
+        for future in pending:
+            future.cancel()
+        # workers that already mapped the buffer keep their mapping until they move on
+        shm.close()
+        shm.unlink()
+    
+    if rendered < page_count:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            for page_num in range(rendered, page_count):
+                yield _render_page(doc.load_page(page_num), zooms[page_num], extract_embedded)
+        finally:
+            doc.close()
+
+
+def _get_render_pool(workers: int) -> ProcessPoolExecutor:
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn: the server process owns a CUDA context and threads, which must not be forked
+            _render_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=mp.get_context('spawn'),
+                initializer=_init_render_worker
+            )
+        return _render_pool
+
+
+def _discard_render_pool(pool: ProcessPoolExecutor):
+    """Forget a broken pool so the next render creates a new one (unless that already happened)"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_render_pool():
+    """Stop the render worker processes (they are restarted on demand)"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+
+def _init_render_worker():
+    """Render worker initializer"""
+    # the open document must let go of the buffer before the mapping is closed at exit
+    atexit.register(_close_shared_document)
+
+
+def _render_shared_page(
+    shm_name: str,
+    size: int,
+    page_num: int,
+    zoom: Tuple[float, float],
+    extract_embedded: bool = False
+) -> Tuple[int, int, int, bytes]:
+    """Render one page of a PDF in shared memory (worker side); returns (width, height, stride, RGB samples)"""
+    doc = _open_shared_document(shm_name, size)
+    page = doc.load_page(page_num)
+    image = _embedded_page_image(page, zoom) if extract_embedded else None
+    if image is not None:
+        return image.width, image.height, image.width * 3, image.tobytes()
+    pix = page.get_pixmap(matrix=fitz.Matrix(*zoom), colorspace=fitz.csRGB, alpha=False)
+    return pix.width, pix.height, pix.stride, pix.samples
+
+
+def _open_shared_document(shm_name: str, size: int) -> "fitz.Document":
+    """Open the PDF in shared memory `shm_name` without copying it, reusing it across pages"""
+    global _worker_document
+    if _worker_document is not None and _worker_document[0] == shm_name:
+        return _worker_document[3]
+    _close_shared_document()
+    
+    # spawned workers share the parent's resource tracker, so attaching does
+    # not add a second registration; the parent unlinks the segment
+    shm = shared_memory.SharedMemory(name=shm_name)
+    view = shm.buf[:size]
+    doc = fitz.open(stream=view, filetype="pdf")
+    _worker_document = (shm_name, shm, view, doc)
+    return doc
+
+
+def _close_shared_document():
+    global _worker_document
+    if _worker_document is None:
+        return
+    _, shm, view, doc = _worker_document
+    _worker_document = None
+    doc.close()
+    del doc
+    try:
+        view.release()
+        shm.close()
+    except BufferError:
+        # still exported by the document; released with it
+        pass
+
+
+def pdf_to_images_high_quality(
+    pdf_bytes: bytes,
+    dpi: int = 144,
+    workers: int = 0,
+    extract_embedded: bool = False
+) -> List[Image.Image]:
+    """
+    Convert PDF pages to high-quality images.
     
     Args:
-        pil_images: List of PIL Image objects
-        output_path: Path to save the PDF file
+        pdf_bytes: PDF file bytes
+        dpi: Resolution for rendering (default: 144)
+        workers: Render processes for large documents (see iter_pdf_images)
+        extract_embedded: Take scanned pages from their embedded image (see iter_pdf_images)
+        
+    Returns:
+        List of RGB PIL Image objects (one per page)
         
     Raises:
         ValueError: If conversion fails
     """
-    if not pil_images:
-        return
+    try:
+        return list(iter_pdf_images(pdf_bytes, dpi, workers, extract_embedded=extract_embedded))
+    except Exception as e:
+        raise ValueError(f"Failed to convert PDF to images: {str(e)}")
+
+
+async def stream_pdf_images(
+    pdf_bytes: bytes,
+    dpi: int = 144,
+    prefetch: int = 2,
+    workers: int = 0,
+    min_parallel_pages: int = 8,
+    page_size: Optional[PageSizeFn] = None,
+    extract_embedded: bool = False
+) -> AsyncIterator[Image.Image]:
+    """
+    Render PDF pages on a background thread, ahead of the consumer.
     
-    # print(f"[PDF] Converting {len(pil_images)} images to PDF...")
-    image_bytes_list = []
+    At most `prefetch` rendered pages wait for the consumer, so pages are
+    rasterized while earlier ones are being processed and memory does not
+    grow with the page count.
+    
+    Args:
+        pdf_bytes: PDF file bytes
+        dpi: Resolution for rendering (default: 144)
+        prefetch: Pages rendered ahead of the consumer
+        workers: Render processes for large documents (see iter_pdf_images)
+        min_parallel_pages: Smallest page count rendered by the pool
+        page_size: Pixel size per page, overriding `dpi` (see iter_pdf_images)
+        extract_embedded: Take scanned pages from their embedded image (see iter_pdf_images)
+        
+    Yields:
+        RGB PIL Image per page, in page order
+        
+    Raises:
+        ValueError: If rendering fails
+    """
+    # one thread: PyMuPDF documents must not be used concurrently
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-render")
+    pages = iter_pdf_images(pdf_bytes, dpi, workers, min_parallel_pages, page_size, extract_embedded)
+    loop = asyncio.get_running_loop()
+    rendering = deque()
+    try:
+        while True:
+            while len(rendering) < max(1, prefetch):
+                rendering.append(loop.run_in_executor(executor, next, pages, None))
+            try:
+                image = await rendering.popleft()
+            except Exception as e:
+                raise ValueError(f"Failed to convert PDF to images: {str(e)}")
+            if image is None:
+                return
+            yield image
+    finally:
+        for future in rendering:
+            future.cancel()
+        # closes the document after any render still running on the thread
+        executor.submit(pages.close)
+        executor.shutdown(wait=False)
+
+
+def encode_pdf_page(img: Image.Image) -> bytes:
+    """
+    Encode an image as a JPEG page for jpeg_pages_to_pdf.
     
-    for idx, img in enumerate(pil_images, 1):
-        # Convert to RGB if necessary
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+    Args:
+        img: PIL Image object
         
-        # Save to bytes buffer with lower quality to reduce size
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=85, optimize=True)
-        img_bytes = img_buffer.getvalue()
-        image_bytes_list.append(img_bytes)
+    Returns:
+        JPEG bytes
+    """
+    # Convert to RGB if necessary
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    # Save to bytes buffer with lower quality to reduce size
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='JPEG', quality=85, optimize=True)
+    return img_buffer.getvalue()
+
+
+def jpeg_pages_to_pdf(image_bytes_list: List[bytes], output_path: Path):
+    """
+    Write JPEG pages (see encode_pdf_page) to a single PDF file.
+    
+    Args:
+        image_bytes_list: JPEG bytes, one per page
+        output_path: Path to save the PDF file
         
-        # Show progress for large PDFs
-        # if idx % 5 == 0 or idx == len(pil_images):
-        #     print(f"[PDF] Processed {idx}/{len(pil_images)} images")
+    Raises:
+        ValueError: If conversion fails
+    """
+    if not image_bytes_list:
+        return
     
     try:
         # print(f"[PDF] Converting to PDF format...")
@@ -169,3 +576,21 @@ def pil_to_pdf_img2pdf(pil_images: List[Image.Image], output_path: Path):
     except Exception as e:
         # print(f"[PDF] Error creating PDF: {e}")
         raise ValueError(f"Failed to convert images to PDF: {str(e)}")
+
+
+def pil_to_pdf_img2pdf(pil_images: List[Image.Image], output_path: Path):
+    """
+    Convert PIL images to a single PDF file.
+    
+    Args:
+        pil_images: List of PIL Image objects
+        output_path: Path to save the PDF file
+        
+    Raises:
+        ValueError: If conversion fails
+    """
+    if not pil_images:
+        return
+    
+    # print(f"[PDF] Converting {len(pil_images)} images to PDF...")
+    jpeg_pages_to_pdf([encode_pdf_page(img) for img in pil_images], output_path)